@@ -1,10 +1,89 @@
 #!/usr/bin/env python2
 
-import gzip, os, subprocess, sys, tempfile, uuid
+import gzip, hashlib, imp, itertools, marshal, math, multiprocessing, os, shutil, subprocess, sys, tempfile, time, uuid, zlib
 import simplejson as json
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import mapreduce_common
 import symbolicator
 
-def runJob(job, dims, workdir, outfile, local=False):
+# Number of worker processes used for symbolication; None uses every CPU.
+SYMBOLICATE_PROCESSES = None
+# Number of worker processes used to write output files; None uses every CPU.
+OUTPUT_PROCESSES = None
+# gzip compression level of output files, 0 to 9; set with setCompressLevel.
+COMPRESS_LEVEL = 9
+# Encoded JSON is written to the gzip stream in chunks of this size.
+WRITE_BUFFER_SIZE = 1 << 16
+# Directory of previously written output files, named by a digest of their
+# data; set with setOutputCache. None writes every output file from scratch.
+OUTPUT_CACHE = None
+# Entries of OUTPUT_CACHE last used before this time are not used by the
+# current run, and are deleted by pruneOutputCache.
+_output_cache_start = None
+# Bytes of job output read between spills of pending output entries to
+# per-output partitions on disk; None keeps every entry in memory. This
+# bounds memory by input read, not by memory in use, and each output file
+# is still assembled in memory from its partition when it is written.
+SPILL_BYTES = None
+# Number of files to split slug-keyed output files into; 0 writes one file.
+OUTPUT_SHARDS = 0
+# Mapper and reducer counts of a job that has the machine to itself; fewer
+# are used for small inputs and for jobs that run concurrently.
+NUM_MAPPERS = 32
+NUM_REDUCERS = 8
+# Bytes of local input per mapper when sizing a job from its input files.
+MAPPER_INPUT_SIZE = 64 << 20
+# Days of a date range covered by each partial job, and the number of
+# partial jobs to run at once.
+JOB_SPAN_DAYS = 1
+JOB_CONCURRENCY = 4
+# Partials not used by any run for this many days are deleted.
+PARTIAL_RETENTION_DAYS = 30
+
+DATE_FORMAT = '%Y%m%d'
+
+def jobPath(job):
+    return os.path.join(os.path.dirname(sys.argv[0]), job)
+
+def inputSize(datadir, mindate, maxdate):
+    # Input files have their submission date as a dot-separated part of
+    # their name, e.g. <appBuildID>.<submission_date>.v2.log.<uuid>.lzma
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(datadir):
+        for fn in filenames:
+            if any(len(part) == 8 and part.isdigit() and
+                   mindate <= part <= maxdate for part in fn.split('.')):
+                size += os.path.getsize(os.path.join(dirpath, fn))
+    return size
+
+def tuneJob(dims, datadir, concurrency=1):
+    # Split NUM_MAPPERS and NUM_REDUCERS between concurrent jobs, and use
+    # fewer mappers when the local input files in datadir are known to be
+    # small. datadir is None for remote input.
+    mappers = max(1, NUM_MAPPERS // concurrency)
+    reducers = max(1, NUM_REDUCERS // concurrency)
+    dates = next(d for d in dims
+                 if d['field_name'] == 'submission_date')['allowed_values']
+    # dates are a range, a list of dates or '*'
+    if isinstance(dates, dict):
+        dates = [dates['min'], dates['max']]
+    size = 0
+    if datadir and isinstance(dates, list) and dates:
+        size = inputSize(datadir, min(dates), max(dates))
+    if size:
+        mappers = min(mappers, int(math.ceil(float(size) / MAPPER_INPUT_SIZE)))
+        reducers = min(reducers, max(1, mappers // 4))
+    return mappers, reducers
+
+def runJob(job, dims, workdir, outfile, local=False, env=None,
+           concurrency=1, scratch=None):
+    # scratch is the job's own work dir, for jobs that share a data dir
+    # with other concurrent jobs.
+    datadir = os.path.join(workdir, 'cache') if local else workdir
+    # only local input can be sized; for remote input the work dir only
+    # holds partials, checkpoints and job outputs
+    mappers, reducers = tuneJob(dims, datadir if local else None, concurrency)
     with tempfile.NamedTemporaryFile('w', suffix='.json', dir=workdir) as filterfile:
         filterfile.write(json.dumps({
             'version': 1,
@@ -13,71 +92,587 @@ def runJob(job, dims, workdir, outfile, local=False):
         filterfile.flush()
 
         args = ['python', '-m', 'mapreduce.job',
-                os.path.join(os.path.dirname(sys.argv[0]), job),
+                jobPath(job),
                 '--input-filter', filterfile.name,
-                '--num-mappers', '32',
-                '--num-reducers', '8',
-                '--data-dir', os.path.join(workdir, 'cache') if local else workdir,
-                '--work-dir', workdir,
+                '--num-mappers', str(mappers),
+                '--num-reducers', str(reducers),
+                '--data-dir', datadir,
+                '--work-dir', scratch or workdir,
                 '--output', outfile,
                 '--bucket', 'telemetry-published-v2']
         if local:
             args.append('--local-only')
 
-        env = os.environ
+        env = dict(os.environ, **(env or {}))
         print 'Calling %s' % (str(' '.join(args)))
         ret = subprocess.call(args, env=env)
         if ret:
             print 'Error %d' % (ret)
             sys.exit(ret)
 
-def saveFile(outdir, name, index, data, prefix=''):
-    fn = prefix + name + '.json.gz'
-    with gzip.open(os.path.join(outdir, fn), 'wb') as outfile:
-        outfile.write(json.dumps(data, separators=(',', ':')))
-    index[name] = fn
+def fileDigest(*paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+# Local modules that each job imports, other than mapreduce_common.py. Their
+# code is part of the job code that checkpoints and partials depend on.
+JOB_DEPENDENCIES = {
+    'mapreduce-anr.py': ['anr.py'],
+    'mapreduce-bhr-summary.py': ['mapreduce-anr-summary.py'],
+}
+
+def codeDigest(job, *modules):
+    # Hash of the code of job, the modules it imports and the given modules.
+    deps = ['mapreduce_common.py'] + JOB_DEPENDENCIES.get(job, []) + list(modules)
+    return fileDigest(jobPath(job), *[jobPath(dep) for dep in deps])
+
+class Checkpoints:
+    # Manifest of the job outputs produced from a work dir, along with the
+    # inputs they were produced from: a hash of the job code, the dims
+    # (which include the date range) and hashes of the files in the current
+    # directory that the job reads. A stage whose inputs are unchanged and
+    # whose output is still intact is skipped on rerun.
+
+    _MANIFEST = 'checkpoints.json'
+
+    def __init__(self, workdir):
+        self._path = os.path.join(workdir, self._MANIFEST)
+        self._pending = {}
+        try:
+            with open(self._path, 'r') as f:
+                self._stages = json.load(f)
+        except (IOError, ValueError):
+            self._stages = {}
+
+    def stale(self, outfile, job, dims, state=()):
+        # round trip through JSON to compare with the loaded manifest,
+        # and to keep the dims as they are now
+        inputs = json.loads(json.dumps({
+            'job': job,
+            'code': codeDigest(job),
+            'dims': dims,
+            'state': {fn: fileDigest(fn) if os.path.exists(fn) else None
+                      for fn in state},
+        }))
+        self._pending[outfile] = inputs
+        stage = self._stages.get(outfile)
+        if (stage and stage['inputs'] == inputs and
+            os.path.exists(outfile) and
+            os.path.getsize(outfile) == stage['size']):
+            print 'Skipping %s, %s is up to date' % (job, outfile)
+            return False
+        return True
+
+    def done(self, outfile):
+        self._stages[outfile] = {
+            'inputs': self._pending.pop(outfile),
+            'size': os.path.getsize(outfile),
+        }
+        with open(self._path + '.tmp', 'w') as f:
+            f.write(json.dumps(self._stages, separators=(',', ':')))
+        os.rename(self._path + '.tmp', self._path)
+
+class OutputContext:
+    # writes reduced values the same way the mapreduce framework does
+    def __init__(self, outfile):
+        self._outfile = outfile
+
+    def write(self, key, value):
+        self._outfile.write('%s\t%s\n' % (key, value))
+
+def loadJob(job):
+    return imp.load_source(os.path.splitext(job)[0].replace('-', '_'),
+                           jobPath(job))
+
+def mergePartials(module, partials, outfile, scratch):
+    # Merge the partial outputs of the job module with its combine function,
+    # and write the reduced result to outfile like a complete run of the job
+    # would. The partials are sorted by key on disk, so that only the values
+    # of one key are held in memory at a time.
+    keyed = tempfile.NamedTemporaryFile('w', suffix='.txt', dir=scratch)
+    merged = tempfile.NamedTemporaryFile('r', suffix='.txt', dir=scratch)
+    with keyed, merged:
+        for path in partials:
+            with open(path, 'r') as partial:
+                for line in partial:
+                    key, sep, value = line.rstrip('\n').partition('\t')
+                    # equal keys can marshal differently, so sort by their JSON
+                    keyed.write('%s\t%s\t%s\n' % (json.dumps(
+                        mapreduce_common.decodePartial(key),
+                        separators=(',', ':')), key, value))
+        keyed.flush()
+        ret = subprocess.call(['sort', '-s', '-t', '\t', '-k1,1',
+                               '-T', scratch, '-o', merged.name, keyed.name],
+                              env=dict(os.environ, LC_ALL='C'))
+        if ret:
+            print 'Error %d sorting partials of %s' % (ret, module.__name__)
+            sys.exit(ret)
+        with open(outfile, 'w') as out:
+            cx = OutputContext(out)
+            for sortkey, lines in itertools.groupby(
+                    merged, lambda line: line.partition('\t')[0]):
+                values = []
+                for line in lines:
+                    sortkey, key, value = line.rstrip('\n').split('\t')
+                    values.extend(mapreduce_common.decodePartial(value))
+                key = mapreduce_common.decodePartial(key)
+                for k, v in mapreduce_common.combineValues(
+                        module, key, values).iteritems():
+                    module.reduce(k, v, cx)
+
+def prunePartials(jobdir, keep):
+    # delete partials that no run has used for PARTIAL_RETENTION_DAYS
+    cutoff = time.time() - PARTIAL_RETENTION_DAYS * 24 * 60 * 60
+    for fn in os.listdir(jobdir):
+        path = os.path.join(jobdir, fn)
+        if path not in keep and os.path.getmtime(path) < cutoff:
+            print 'Removing unused partial %s' % path
+            os.remove(path)
+
+def runDailyJob(job, dims, workdir, outfile, partialdir, local=False,
+                state=(), span=JOB_SPAN_DAYS, concurrency=JOB_CONCURRENCY):
+    # Run job over span submission dates at a time, a number of runs at once,
+    # and keep the combined output of each run in partialdir, so that later
+    # runs over overlapping date ranges only compute new days. state lists
+    # the files in the current directory that the job reads; partials are
+    # only reused while those and the job code are unchanged. Partials of
+    # jobs without a combine function would hold every mapped value, so
+    # those jobs are run over the whole range instead.
+    module = loadJob(job)
+    if not hasattr(module, 'combine'):
+        print '%s has no combine function, running over the whole range' % job
+        runJob(job, dims, workdir, outfile, local=local)
+        return
+
+    datedim = next(d for d in dims if d['field_name'] == 'submission_date')
+    digest = hashlib.sha1(json.dumps(
+        [d for d in dims if d is not datedim], sort_keys=True))
+    digest.update(codeDigest(job, 'mapreduce-partial.py'))
+    for fn in state:
+        if os.path.exists(fn):
+            with open(fn, 'rb') as f:
+                digest.update(f.read())
+    jobdir = os.path.join(partialdir, os.path.splitext(job)[0])
+    if not os.path.exists(jobdir):
+        os.makedirs(jobdir)
+
+    partials = []
+    pending = []
+    date = datetime.strptime(datedim['allowed_values']['min'], DATE_FORMAT)
+    maxdate = datetime.strptime(datedim['allowed_values']['max'], DATE_FORMAT)
+    while date <= maxdate:
+        first = date.strftime(DATE_FORMAT)
+        date = min(date + timedelta(days=span - 1), maxdate)
+        last = date.strftime(DATE_FORMAT)
+        date += timedelta(days=1)
+        partial = os.path.join(jobdir, '%s-%s-%s.txt' % (
+            first, last, digest.hexdigest()))
+        if not os.path.exists(partial):
+            pending.append((first, last, partial))
+        else:
+            print 'Reusing %s' % partial
+            # mark the partial as used, for prunePartials
+            os.utime(partial, None)
+        partials.append(partial)
+    prunePartials(jobdir, set(partials))
+
+    def runPartial(args):
+        first, last, partial = args
+        partdims = [dict(d, allowed_values={'min': first, 'max': last})
+                    if d is datedim else d for d in dims]
+        # concurrent jobs need separate work dirs
+        scratch = tempfile.mkdtemp(prefix='partial-', dir=workdir)
+        try:
+            runJob('mapreduce-partial.py', partdims, workdir, partial + '.tmp',
+                   local=local, env={'PARTIAL_JOB': jobPath(job)},
+                   concurrency=min(concurrency, len(pending)),
+                   scratch=scratch)
+        except SystemExit:
+            return False
+        finally:
+            shutil.rmtree(scratch, True)
+        # only complete partials are ever picked up
+        os.rename(partial + '.tmp', partial)
+        return True
+
+    pool = ThreadPool(max(1, min(concurrency, len(pending))))
+    try:
+        results = pool.map(runPartial, pending, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if not all(results):
+        print 'Error running %s' % job
+        sys.exit(1)
+    mergePartials(module, partials, outfile, workdir)
+
+def planSampling(summaryfile, budget):
+    # Allocate a budget of pings across strata by water-filling: strata
+    # smaller than their fair share are kept in full, and the rest are
+    # down-sampled to an equal number of pings each.
+    strata = {}
+    for line in summaryfile:
+        parts = line.partition('\t')
+        key = json.loads(parts[0])
+        if key[0] == 'stratum':
+            strata[key[1]] = json.loads(parts[2])[0]
+
+    plan = {}
+    remaining = float(budget)
+    ordered = sorted(strata.iteritems(), key=lambda x: x[1])
+    for i, (stratum, count) in enumerate(ordered):
+        share = remaining / (len(ordered) - i)
+        rate = 1.0 if count <= share else share / count
+        remaining -= count * rate
+        # relative standard error of a count estimated from this stratum
+        error = math.sqrt((1.0 - rate) / (rate * count)) if count else 0.0
+        plan[stratum] = {
+            'count': count,
+            'rate': rate,
+            'weight': 1.0 / rate,
+            'error': error,
+        }
+
+    total = sum(strata.itervalues())
+    variance = sum(p['count'] * (1.0 - p['rate']) / p['rate']
+                   for p in plan.itervalues())
+    return {
+        'budget': budget,
+        'strata': plan,
+        'error': math.sqrt(variance) / total if total else 0.0,
+    }
 
-def processDims(index, dims, allowed_infos, jobfile, outdir):
-    mainthreads = {}
-    backgroundthreads = {}
-    slugs = {}
-    dimsinfo = {}
+def writeJSON(outfile, data):
+    # Encode one top-level entry at a time with the C encoder, instead of
+    # building the whole string; iterencode would use the Python encoder.
+    if not isinstance(data, dict):
+        outfile.write(json.dumps(data, separators=(',', ':')))
+        return
+    chunks = ['{']
+    size = 0
+    for i, (key, value) in enumerate(data.iteritems()):
+        chunk = json.dumps({key: value}, separators=(',', ':'))[1:-1]
+        chunks.append(',' + chunk if i else chunk)
+        size += len(chunk)
+        if size >= WRITE_BUFFER_SIZE:
+            outfile.write(''.join(chunks))
+            chunks = []
+            size = 0
+    chunks.append('}')
+    outfile.write(''.join(chunks))
+
+def setCompressLevel(level):
+    global COMPRESS_LEVEL
+    if not 0 <= level <= 9:
+        raise ValueError('Invalid compression level %d' % level)
+    COMPRESS_LEVEL = level
+
+def setOutputCache(path):
+    global OUTPUT_CACHE, _output_cache_start
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+    OUTPUT_CACHE = path or None
+    # allow for file systems that keep whole seconds
+    _output_cache_start = int(time.time()) - 1
+
+def pruneOutputCache():
+    # delete the cache entries that the current run did not use
+    if not OUTPUT_CACHE:
+        return
+    for fn in os.listdir(OUTPUT_CACHE):
+        path = os.path.join(OUTPUT_CACHE, fn)
+        if os.path.getmtime(path) < _output_cache_start:
+            os.remove(path)
+
+def canonicalData(data):
+    # Data as marshallable values that do not depend on dict order: dicts
+    # become tuples of their sorted items, and tuples become lists, which
+    # encode to the same JSON.
+    if isinstance(data, dict):
+        return tuple(sorted((key, canonicalData(value))
+                            for key, value in data.iteritems()))
+    if isinstance(data, (list, tuple)):
+        return [canonicalData(value) for value in data]
+    return data
+
+def dataDigest(level, data):
+    # marshal is much cheaper than encoding and compressing the data. Output
+    # files are usually keyed by slug, so the digest is computed one entry
+    # at a time instead of marshalling the whole file at once. marshal
+    # version 0 does not depend on which strings happen to be interned.
+    digest = hashlib.sha1(marshal.dumps((level, type(data).__name__), 0))
+    if isinstance(data, dict):
+        for key in sorted(data):
+            digest.update(marshal.dumps((key, canonicalData(data[key])), 0))
+    else:
+        digest.update(marshal.dumps(canonicalData(data), 0))
+    return digest.hexdigest()
+
+def writeFile(path, data, level=None):
+    level = COMPRESS_LEVEL if level is None else level
+    cached = None
+    if OUTPUT_CACHE:
+        # unchanged files are copied from the cache
+        try:
+            cached = os.path.join(OUTPUT_CACHE,
+                                  dataDigest(level, data) + '.json.gz')
+        except ValueError:
+            pass
+    if cached and os.path.exists(cached):
+        shutil.copyfile(cached, path)
+        # mark the entry as used, for pruneOutputCache
+        os.utime(cached, None)
+        return
+    with gzip.open(path, 'wb', level) as outfile:
+        writeJSON(outfile, data)
+    if cached:
+        tmp = tempfile.NamedTemporaryFile(dir=OUTPUT_CACHE, delete=False)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, tmp)
+        tmp.close()
+        os.rename(tmp.name, cached)
+
+_pending_outputs = None
+
+def writePendingOutput(index):
+    path, data = _pending_outputs[index]
+    writeFile(path, data)
+
+class OutputWriter:
+    # Collects output files and writes them all in worker processes on close.
+    # Workers are forked after the files are collected, so they inherit the
+    # data instead of receiving a pickled copy.
+
+    def __init__(self, processes=OUTPUT_PROCESSES):
+        self._processes = processes
+        self._outputs = []
+
+    def add(self, path, data):
+        self._outputs.append((path, data))
+
+    def close(self):
+        global _pending_outputs
+        outputs, self._outputs = self._outputs, []
+        if len(outputs) <= 1 or self._processes == 1:
+            for path, data in outputs:
+                writeFile(path, data)
+            return
+        _pending_outputs = outputs
+        pool = multiprocessing.Pool(self._processes)
+        try:
+            pool.map(writePendingOutput, range(len(outputs)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _pending_outputs = None
+
+def slugShard(slug, shards):
+    # crc32 is simple to reproduce in clients, unlike Python's hash()
+    return (zlib.crc32(slug.encode('utf-8')) & 0xffffffff) % shards
+
+def saveFile(outdir, name, index, data, prefix='', writer=None, shards=0):
+    # With shards, data must be keyed by slug. It is split into that many
+    # files by slugShard and index[name] lists the file of each shard.
+    if shards:
+        parts = [{} for i in range(shards)]
+        for slug, value in data.iteritems():
+            parts[slugShard(slug, shards)][slug] = value
+        files = [('%s%s.%d.json.gz' % (prefix, name, i), part)
+                 for i, part in enumerate(parts)]
+        index[name] = [fn for fn, part in files]
+    else:
+        files = [(prefix + name + '.json.gz', data)]
+        index[name] = files[0][0]
+    for fn, part in files:
+        if writer:
+            writer.add(os.path.join(outdir, fn), part)
+        else:
+            writeFile(os.path.join(outdir, fn), part)
+
+def symbolicateBuild(args):
+    info, stacks, scratch = args
+    return symbolicator.symbolicateStacks(stacks, scratch=scratch, info=info)
+
+def symbolicateThreads(threads, scratch, processes=SYMBOLICATE_PROCESSES):
+    # threads is a list of (thread, info) pairs. Threads are grouped by build
+    # so that each worker process loads a build's symbols only once, and
+    # stacks are written back to their threads in the original order.
+    # Identical stacks from the same build are only symbolicated once.
+    builds = {}
+    for thread, info in threads:
+        key = symbolicator.buildKey(info)
+        stacks = builds.setdefault(key, (info, {}))[1]
+        stacks.setdefault(tuple(thread['stack']), []).append(thread)
+
+    # largest builds first, so they don't end up last in a worker's queue
+    tasks = sorted(((info, stacks.items()) for info, stacks
+                    in builds.itervalues()), key=lambda b: -len(b[1]))
+    args = [(info, [list(stack) for stack, stack_threads in stacks], scratch)
+            for info, stacks in tasks]
+    # fetch the symbols of every build whose stacks are not all in the
+    # symbol cache up front, concurrently
+    symbolicator.prefetchSymbols(scratch, [
+        info for info, stacks in tasks
+        if symbolicator.needsSymbols([stack for stack, stack_threads
+                                      in stacks], info)])
+
+    unique = sum(len(stacks) for info, stacks in tasks)
+    if threads:
+        print 'Symbolicating %d unique stacks from %d threads (%.1fx dedup)' % (
+            unique, len(threads), float(len(threads)) / unique)
+    if len(args) <= 1 or processes == 1:
+        results = [symbolicateBuild(a) for a in args]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(symbolicateBuild, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for (info, stacks), results in zip(tasks, results):
+        for (stack, stack_threads), result in zip(stacks, results):
+            for thread in stack_threads:
+                thread['stack'] = list(result)
+
+class OutputPartitions:
+    # Collects the entries of each output file, where an entry is a value and
+    # the path of keys to it inside the file. Outputs are identified by
+    # (index section, file prefix, name) and the section is None for files
+    # listed at the top level of the index. Threads with native frames are
+    # symbolicated before their entries are written out.
+    #
+    # With a spill threshold, pending entries are spilled to one partition
+    # file per output once the job output read since the last spill exceeds
+    # the threshold, and each output file is assembled from its partition
+    # on save.
+
+    def __init__(self, scratch, spill_bytes=SPILL_BYTES):
+        self._scratch = scratch
+        self._spillBytes = spill_bytes
+        self._spilldir = None
+        self._partitions = {}
+        self._entries = {}
+        self._threads = []
+        self._size = 0
+
+    def add(self, output, keys, value):
+        self._entries.setdefault(output, []).append((keys, value))
+
+    def addThread(self, thread, info):
+        self._threads.append((thread, info))
+
+    def consumed(self, size):
+        self._size += size
+        if self._spillBytes is not None and self._size > self._spillBytes:
+            self.spill()
+
+    def _symbolicate(self):
+        symbolicateThreads(self._threads, self._scratch)
+        self._threads = []
+
+    def spill(self):
+        self._symbolicate()
+        if self._spilldir is None:
+            self._spilldir = tempfile.mkdtemp(dir=self._scratch)
+        for output, entries in self._entries.iteritems():
+            path = self._partitions.get(output)
+            if path is None:
+                path = os.path.join(self._spilldir,
+                                    '%d.txt' % len(self._partitions))
+                self._partitions[output] = path
+            with open(path, 'a') as partition:
+                for entry in entries:
+                    partition.write(json.dumps(entry, separators=(',', ':')))
+                    partition.write('\n')
+        self._entries = {}
+        self._size = 0
+
+    def _assemble(self, output):
+        data = {}
+        def addEntry(keys, value):
+            dest = data
+            for key in keys[:-1]:
+                dest = dest.setdefault(key, {})
+            dest[keys[-1]] = value
+        path = self._partitions.pop(output, None)
+        if path:
+            with open(path, 'r') as partition:
+                for line in partition:
+                    addEntry(*json.loads(line))
+            os.remove(path)
+        for keys, value in self._entries.pop(output, ()):
+            addEntry(keys, value)
+        return data
+
+    def save(self, outdir, index, shards=OUTPUT_SHARDS,
+             sharded=(None, 'dimensions')):
+        # Files in the sharded index sections are keyed by slug and are
+        # split into shards files; index['shards'] then records how slugs
+        # map to shards, so clients can compute the shard of a slug.
+        self._symbolicate()
+        outputs = sorted(set(self._partitions) | set(self._entries))
+        spilled = bool(self._partitions)
+        writer = OutputWriter()
+        for output in outputs:
+            section, prefix, name = output
+            data = self._assemble(output)
+            output_shards = shards if section in sharded else 0
+            saveFile(outdir, name, index[section] if section else index,
+                     data, prefix=prefix, writer=writer, shards=output_shards)
+            # spilled outputs are assembled and written one at a time
+            if spilled:
+                writer.close()
+        writer.close()
+        if shards:
+            index['shards'] = {'count': shards, 'hash': 'crc32'}
+        if self._spilldir:
+            shutil.rmtree(self._spilldir, True)
+            self._spilldir = None
+
+def processDims(index, dims, allowed_infos, jobfile, outdir,
+                spill_bytes=SPILL_BYTES, shards=OUTPUT_SHARDS):
+    outputs = OutputPartitions(os.path.dirname(jobfile.name), spill_bytes)
     dimvalues = {}
     for line in jobfile:
+        outputs.consumed(len(line))
         anr = json.loads(line.partition('\t')[2])
         slug = anr['slugs'][0][-1]
-        slugs[slug] = anr['slugs']
+        outputs.add((None, '', 'slugs'), (slug,), anr['slugs'])
         for t in anr['threads']:
             sym_info = t.pop('info')
             if not any(f.startswith('c:') for f in t['stack']):
                 # Don't symbolicate if we don't have native frames.
                 continue
             assert sym_info
-            t['stack'] = list(
-                symbolicator.symbolicateStack(t['stack'],
-                    scratch=os.path.dirname(jobfile.name), info=sym_info))
+            outputs.addThread(t, sym_info)
         mainthread = next(t for t in anr['threads']
                           if t['name'] == anr['display'])
-        mainthreads[slug] = [mainthread]
-        backgroundthreads[slug] = [t for t in anr['threads']
-                                   if t is not mainthread]
+        outputs.add((None, '', 'main_thread'), (slug,), [mainthread])
+        outputs.add((None, '', 'background_threads'), (slug,),
+                    [t for t in anr['threads'] if t is not mainthread])
         info = anr['info']
         for dimname, infocounts in info.iteritems():
             for key, value in infocounts.iteritems():
-                dimsinfo.setdefault(
-                    dimname, {}).setdefault(slug, {})[key] = value
+                outputs.add(('dimensions', 'dim_', dimname),
+                            (slug, key), value)
                 dimvalues.setdefault(dimname, set()).add(key)
                 for k, v in value.iteritems():
                     allowed_infos.setdefault(k, set()).update(v.iterkeys())
 
-    saveFile(outdir, 'slugs', index, slugs)
-    saveFile(outdir, 'main_thread', index, mainthreads)
-    saveFile(outdir, 'background_threads', index, backgroundthreads)
+    # narrow the dims of later jobs to the values seen here, but keep the
+    # date range, which runDailyJob splits into partial jobs
     dummy_dict = {}
-    for field, dim in dimsinfo.iteritems():
+    for field, values in dimvalues.iteritems():
+        if field == 'submission_date':
+            continue
         next((d for d in dims if d['field_name'] == field), dummy_dict)[
-            'allowed_values'] = list(dimvalues[field])
-        saveFile(outdir, field, index['dimensions'], dim, prefix='dim_')
+            'allowed_values'] = sorted(values)
+    outputs.save(outdir, index, shards)
 
 def processSessions(index, dims, allowed_infos, sessionsfile, outdir):
     sessions = {}
@@ -96,15 +691,15 @@ def processSessions(index, dims, allowed_infos, sessionsfile, outdir):
                      if k in allowed_infos}
         sessions.setdefault(key[0],
             {'uptime': {}})['uptime'][key[1]] = aggregate
+    writer = OutputWriter()
     for fieldname, sessionsvalue in sessions.iteritems():
         saveFile(outdir, fieldname,
-            index['sessions'], sessionsvalue, prefix='ses_')
+            index['sessions'], sessionsvalue, prefix='ses_', writer=writer)
+    writer.close()
 
-def processBHR(index, jobfile, outdir):
-    mainthreads = {}
-    nativethreads = {}
-    dimsinfo = {}
-    sessions = {}
+def processBHR(index, jobfile, outdir, spill_bytes=SPILL_BYTES,
+               shards=OUTPUT_SHARDS):
+    outputs = OutputPartitions(os.path.dirname(jobfile.name), spill_bytes)
 
     def adjustCounts(dim_vals, slug):
         for dim_val, info_keys in dim_vals.iteritems():
@@ -118,17 +713,18 @@ def processBHR(index, jobfile, outdir):
                 max_count = max(max_count, info_count)
         return dim_vals
 
-    def mergeHangTime(dest, slug, dim_vals):
+    def mergeHangTime(output, slug, dim_vals):
         for dim_val, info_keys in dim_vals.iteritems():
             dest_histogram = {}
             for time_histogram in info_keys['appName'].itervalues():
                 for time, counts in time_histogram.iteritems():
                     dest_histogram[time] = (counts +
                         dest_histogram.get(time, 0))
-            dest.setdefault(dim_val, {}).setdefault(
-                'name', {})[slug] = dest_histogram
+            outputs.add(output, ('hangtime', dim_val, 'name', slug),
+                        dest_histogram)
 
     for line in jobfile:
+        outputs.consumed(len(line))
         parts = line.partition('\t')
         keys = json.loads(parts[0])
         stats = json.loads(parts[2])
@@ -139,51 +735,48 @@ def processBHR(index, jobfile, outdir):
                 tag += ':' + keys[1]
             for k, v in stats[0].iteritems():
                 for vk, vv in v.iteritems():
-                    sessions.setdefault(k, {}).setdefault(tag, {})[vk] = vv
+                    outputs.add(('sessions', 'ses_', k), (tag, vk), vv)
             continue
         if keys[1] is None:
             # activity measurements
             tag = 'activity:' + keys[0]
             for k, v in stats[0].iteritems():
-                sessions.setdefault(k, {})[tag] = v
+                outputs.add(('sessions', 'ses_', k), (tag,), v)
             continue
         # hang measurements
         slug = keys[1]
         stack = stats[1][0][0] + ['p:' + keys[0]]
-        mainthreads[slug] = [{'name': 'main', 'stack': stack}]
+        outputs.add((None, '', 'main_thread'), (slug,),
+                    [{'name': 'main', 'stack': stack}])
 
         for k, v in stats[0].iteritems():
-            mergeHangTime(sessions.setdefault(k, {})
-                                  .setdefault('hangtime', {}), slug, v)
-            dimsinfo.setdefault(k, {})[slug] = adjustCounts(v, slug)
+            mergeHangTime(('sessions', 'ses_', k), slug, v)
+            outputs.add(('dimensions', 'dim_', k), (slug,),
+                        adjustCounts(v, slug))
 
         if not stats[1][1]:
             continue
 
+        nativethreads = []
         for k, v in stats[1][1].iteritems():
             for vk, vv in v.iteritems():
-                nativethreads.setdefault(slug, []).append({
+                thread = {
                     'name': 'native (dim:%s:%s)' % (k, vk),
-                    'stack': list(symbolicator.symbolicateStack(vv[0],
-                        scratch=os.path.dirname(jobfile.name), info=vv[1]))
-                })
-
-    saveFile(outdir, 'main_thread', index, mainthreads)
-    saveFile(outdir, 'background_threads', index, nativethreads)
-    for field, dim in dimsinfo.iteritems():
-        saveFile(outdir, field, index['dimensions'], dim, prefix='dim_')
-    for fieldname, sessionsvalue in sessions.iteritems():
-        saveFile(outdir, fieldname, index['sessions'], sessionsvalue, prefix='ses_')
+                    'stack': vv[0]
+                }
+                nativethreads.append(thread)
+                outputs.addThread(thread, vv[1])
+        # each slug is reduced to a single line of job output
+        outputs.add((None, '', 'background_threads'), (slug,), nativethreads)
 
-if __name__ == '__main__':
+    outputs.save(outdir, index, shards)
 
-    from datetime import datetime, timedelta
+if __name__ == '__main__':
 
     if len(sys.argv) != 3:
         print 'Usage %s <from> <to>' % (sys.argv[0])
         sys.exit(1)
 
-    DATE_FORMAT = '%Y%m%d'
     fromDate = datetime.strptime(sys.argv[1], DATE_FORMAT)
     toDate = datetime.strptime(sys.argv[2], DATE_FORMAT)
 
@@ -207,6 +800,18 @@ if __name__ == '__main__':
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    symbolicator.setSymbolCache(os.path.join('/mnt', 'symbol-cache.sqlite'))
+    symbolicator.setSymbolServer(os.environ.get('SYMBOL_SERVER', ''))
+    output_cache = os.environ.get('OUTPUT_CACHE')
+    if output_cache:
+        setOutputCache(os.path.join(output_cache, 'anr'))
+    spill_bytes = os.environ.get('SPILL_BYTES')
+    spill_bytes = int(spill_bytes) if spill_bytes else None
+    shards = int(os.environ.get('OUTPUT_SHARDS', 0))
+    compress_level = os.environ.get('COMPRESS_LEVEL')
+    if compress_level:
+        setCompressLevel(int(compress_level))
+
     print 'Range: %s to %s' % (mindate, maxdate)
     print 'Work dir: %s' % workdir
     print 'Out dir: %s' % outdir
@@ -241,23 +846,40 @@ if __name__ == '__main__':
         'sessions': {},
     }
     allowed_infos = {}
-    with tempfile.NamedTemporaryFile('r', suffix='.txt', dir=workdir) as outfile:
-        runJob("mapreduce-anr.py", dims, workdir, outfile.name, local=worklocalonly)
-        with open(outfile.name, 'r') as jobfile:
-            processDims(index, dims, allowed_infos, jobfile, outdir)
-
-    with tempfile.NamedTemporaryFile('r', suffix='.txt', dir=sessionsdir) as outfile:
-        local = 'saved-session' in dims[0]['allowed_values'] or sessionlocalonly
-        dims[0]['allowed_values'] = ['saved-session'];
-        runJob("mapreduce-anr-sessions.py", dims, sessionsdir, outfile.name, local=local)
-        with open(outfile.name, 'r') as sessionsfile:
-            processSessions(index, dims, allowed_infos, sessionsfile, outdir)
-
-    runJob("mapreduce-anr-summary.py", dims, sessionsdir,
-           os.path.join(outdir, 'summary.txt'), local=True)
+    checkpoints = Checkpoints(workdir)
+    anrout = os.path.join(workdir, 'anr.txt')
+    if checkpoints.stale(anrout, "mapreduce-anr.py", dims):
+        # reduce needs every report, which cannot be combined into partials
+        runJob("mapreduce-anr.py", dims, workdir, anrout,
+               local=worklocalonly)
+        checkpoints.done(anrout)
+    with open(anrout, 'r') as jobfile:
+        processDims(index, dims, allowed_infos, jobfile, outdir,
+                    spill_bytes=spill_bytes, shards=shards)
+
+    checkpoints = Checkpoints(sessionsdir)
+    # processDims narrowed the dims to the ANR output of this range, so
+    # these partials are only kept with the range
+    partialdir = os.path.join(sessionsdir, 'partials')
+    sessionsout = os.path.join(sessionsdir, 'sessions.txt')
+    local = 'saved-session' in dims[0]['allowed_values'] or sessionlocalonly
+    dims[0]['allowed_values'] = ['saved-session'];
+    if checkpoints.stale(sessionsout, "mapreduce-anr-sessions.py", dims):
+        runDailyJob("mapreduce-anr-sessions.py", dims, sessionsdir,
+                    sessionsout, partialdir, local=local)
+        checkpoints.done(sessionsout)
+    with open(sessionsout, 'r') as sessionsfile:
+        processSessions(index, dims, allowed_infos, sessionsfile, outdir)
+
+    summaryout = os.path.join(outdir, 'summary.txt')
+    if checkpoints.stale(summaryout, "mapreduce-anr-summary.py", dims):
+        runDailyJob("mapreduce-anr-summary.py", dims, sessionsdir,
+                    summaryout, partialdir, local=True)
+        checkpoints.done(summaryout)
 
     with open(os.path.join(outdir, 'index.json'), 'w') as outfile:
         outfile.write(json.dumps(index, separators=(',', ':')))
 
+    pruneOutputCache()
     print 'Completed'
 
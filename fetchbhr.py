@@ -2,15 +2,21 @@
 
 if __name__ == '__main__':
 
-    import os, shutil, sys, tempfile
+    import os, shutil, sys
     import simplejson as json
     from datetime import datetime, timedelta
-    from fetchanr import processBHR, runJob
+    import symbolicator
+    from fetchanr import (Checkpoints, planSampling, processBHR,
+                          pruneOutputCache, runDailyJob, setCompressLevel,
+                          setOutputCache)
 
-    if len(sys.argv) != 3:
-        print 'Usage %s <from> <to>' % (sys.argv[0])
+    if len(sys.argv) != 3 and len(sys.argv) != 4:
+        print 'Usage %s <from> <to> [<ping budget>]' % (sys.argv[0])
         sys.exit(1)
 
+    # Total number of pings to sample across all strata; 0 disables sampling.
+    budget = int(sys.argv[3]) if len(sys.argv) == 4 else 0
+
     DATE_FORMAT = '%Y%m%d'
     fromDate = datetime.strptime(sys.argv[1], DATE_FORMAT)
     toDate = datetime.strptime(sys.argv[2], DATE_FORMAT)
@@ -30,6 +36,24 @@ if __name__ == '__main__':
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    # per-day partial job output, kept with the range: the summary pass
+    # fills the local cache that the later passes read, so it has to
+    # download every day of the range, and the filter and data passes
+    # depend on the summary of the whole range
+    partialdir = os.path.join(workdir, 'partials')
+
+    symbolicator.setSymbolCache(os.path.join('/mnt', 'symbol-cache.sqlite'))
+    symbolicator.setSymbolServer(os.environ.get('SYMBOL_SERVER', ''))
+    output_cache = os.environ.get('OUTPUT_CACHE')
+    if output_cache:
+        setOutputCache(os.path.join(output_cache, 'bhr'))
+    spill_bytes = os.environ.get('SPILL_BYTES')
+    spill_bytes = int(spill_bytes) if spill_bytes else None
+    shards = int(os.environ.get('OUTPUT_SHARDS', 0))
+    compress_level = os.environ.get('COMPRESS_LEVEL')
+    if compress_level:
+        setCompressLevel(int(compress_level))
+
     print 'Range: %s to %s' % (mindate, maxdate)
     print 'Work dir: %s' % workdir
     print 'Out dir: %s' % outdir
@@ -74,21 +98,58 @@ if __name__ == '__main__':
         'sessions': {},
     }
 
-    summaryout = os.path.join(outdir, 'summary.txt')
-    runJob("mapreduce-bhr-summary.py", dims, workdir, summaryout, local=localonly)
+    checkpoints = Checkpoints(workdir)
+    summaryout = os.path.join(workdir, 'summary.txt')
+    if checkpoints.stale(summaryout, "mapreduce-bhr-summary.py", dims):
+        runDailyJob("mapreduce-bhr-summary.py", dims, workdir, summaryout,
+                    partialdir, local=localonly)
+        checkpoints.done(summaryout)
     shutil.copyfile(summaryout, 'summary.txt')
-
-    with tempfile.NamedTemporaryFile('r', suffix='.txt', dir=workdir) as filterout:
-        runJob("mapreduce-bhr-filter.py", dims, workdir, filterout.name, local=True)
-        shutil.copyfile(filterout.name, 'filter.txt')
-
-    with tempfile.NamedTemporaryFile('r', suffix='.txt', dir=workdir) as outfile:
-        runJob("mapreduce-bhr.py", dims, workdir, outfile.name, local=True)
-        with open(outfile.name, 'r') as jobfile:
-            processBHR(index, jobfile, outdir)
+    # the stratum counts are only used to plan sampling, so they are left
+    # out of the published summary
+    with open(summaryout, 'r') as summaryfile:
+        with open(os.path.join(outdir, 'summary.txt'), 'w') as published:
+            for line in summaryfile:
+                if json.loads(line.partition('\t')[0])[0] != 'stratum':
+                    published.write(line)
+
+    if budget:
+        with open(summaryout, 'r') as summaryfile:
+            sampling = planSampling(summaryfile, budget)
+        with open('sampling.txt', 'w') as samplingfile:
+            samplingfile.write(json.dumps({
+                stratum: plan['rate']
+                for stratum, plan in sampling['strata'].iteritems()
+            }))
+        index['sampling'] = sampling
+        print 'Sampling: %d pings, estimated error %.4f' % (
+            budget, sampling['error'])
+    elif os.path.exists('sampling.txt'):
+        os.remove('sampling.txt')
+
+    filterout = os.path.join(workdir, 'filter.txt')
+    if checkpoints.stale(filterout, "mapreduce-bhr-filter.py", dims,
+                         state=('summary.txt', 'sampling.txt')):
+        runDailyJob("mapreduce-bhr-filter.py", dims, workdir, filterout,
+                    partialdir, local=True,
+                    state=('summary.txt', 'sampling.txt'))
+        checkpoints.done(filterout)
+    shutil.copyfile(filterout, 'filter.txt')
+
+    bhrout = os.path.join(workdir, 'bhr.txt')
+    if checkpoints.stale(bhrout, "mapreduce-bhr.py", dims,
+                         state=('summary.txt', 'sampling.txt', 'filter.txt')):
+        runDailyJob("mapreduce-bhr.py", dims, workdir, bhrout,
+                    partialdir, local=True,
+                    state=('summary.txt', 'sampling.txt', 'filter.txt'))
+        checkpoints.done(bhrout)
+    with open(bhrout, 'r') as jobfile:
+        processBHR(index, jobfile, outdir, spill_bytes=spill_bytes,
+                   shards=shards)
 
     with open(os.path.join(outdir, 'index.json'), 'w') as outfile:
         outfile.write(json.dumps(index, separators=(',', ':')))
 
+    pruneOutputCache()
     print 'Completed'
 
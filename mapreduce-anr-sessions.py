@@ -1,9 +1,13 @@
+import math
 import simplejson as json
 import mapreduce_common
 
 mapreduce_common.allowed_infos = mapreduce_common.allowed_infos_anr
 mapreduce_common.allowed_dimensions = mapreduce_common.allowed_dimensions_anr
 
+def uptimeBucket(uptime):
+    return round(math.log(uptime + 1), 2)
+
 def map(slug, dims, value, context):
     ping = json.loads(value)
     if ('info' not in ping or
@@ -18,20 +22,53 @@ def map(slug, dims, value, context):
         return
     info = mapreduce_common.filterInfo(ping['info'])
     mapreduce_common.addUptime(info, ping)
+    bucket = uptimeBucket(uptime)
     for name, dim in mapreduce_common.filterDimensions(dims, info).iteritems():
-        context.write((name, dim), (uptime, info))
+        # aggregate maps info key -> info value -> uptime bucket -> (count, sum)
+        context.write((name, dim), {
+            k: {v: {bucket: (1, uptime)}} for k, v in info.iteritems()
+        })
+
+def mergeAggregates(values):
+    aggregate = {}
+    for value in values:
+        for k, infovals in value.iteritems():
+            dest_infovals = aggregate.setdefault(k, {})
+            for v, buckets in infovals.iteritems():
+                dest_buckets = dest_infovals.setdefault(v, {})
+                for bucket, (count, total) in buckets.iteritems():
+                    dest_count, dest_total = dest_buckets.get(bucket, (0, 0))
+                    dest_buckets[bucket] = (dest_count + count,
+                                            dest_total + total)
+    return aggregate
+
+def combine(key, values, context):
+    context.write(key, mergeAggregates(values))
 
 def reduce(key, values, context):
     if not values:
         return
-    aggregate = {}
-    lower, upper = mapreduce_common.estQuantile(values, 10, key=lambda x:x[0])
+    aggregate = mergeAggregates(values)
+    if not aggregate:
+        return
+
+    # every ping contributes once to every info key,
+    # so any single info key gives the uptime histogram of all pings
+    histogram = {}
+    for buckets in next(aggregate.itervalues()).itervalues():
+        for bucket, (count, total) in buckets.iteritems():
+            histogram[bucket] = histogram.get(bucket, 0) + count
+
+    lower, upper = mapreduce_common.estHistogramQuantile(histogram, 10)
     lower = int(round(lower))
     upper = int(round(upper))
-    for uptime, value in values:
-        uptime = max(min(uptime, upper), lower)
-        for k, v in value.iteritems():
-            bucket = aggregate.setdefault(k, {})
-            bucket[v] = bucket.get(v, 0) + uptime
+
+    def clampedSum(count, total):
+        return max(min(total, upper * count), lower * count)
+
+    out = {k: {v: sum(clampedSum(count, total)
+                      for count, total in buckets.itervalues())
+               for v, buckets in infovals.iteritems()}
+           for k, infovals in aggregate.iteritems()}
     context.write(json.dumps(key, separators=(',', ':')),
-                  json.dumps(aggregate, separators=(',', ':')))
+                  json.dumps(out, separators=(',', ':')))
@@ -1,16 +1,22 @@
+import math
 import simplejson as json
 import mapreduce_common
 
 mapreduce_common.allowed_infos = mapreduce_common.allowed_infos_anr
 mapreduce_common.allowed_dimensions = mapreduce_common.allowed_dimensions_anr
 
+def summaryValue(x):
+    # values are written as sparse histograms of log(x + 1) buckets, mapping
+    # each bucket to (count, sum), so that they can be combined
+    return {round(math.log(x + 1), 2): (1, x)}
+
 def map(slug, dims, value, context):
-    context.write(("ping", "all"), 1)
+    context.write(("ping", "all"), summaryValue(1))
     ping = json.loads(value)
     if ('info' not in ping or
         'simpleMeasurements' not in ping or
         'uptime' not in ping['simpleMeasurements']):
-        context.write(("ping", "corrupt"), 1)
+        context.write(("ping", "corrupt"), summaryValue(1))
         return
     raw_sm = ping['simpleMeasurements']
     uptime = raw_sm['uptime']
@@ -23,15 +29,31 @@ def map(slug, dims, value, context):
     aggregate = dict(info.items() +
         mapreduce_common.filterDimensions(dims, info).items())
     for name, dim in aggregate.iteritems():
-        context.write((name, dim), uptime)
+        context.write((name, dim), summaryValue(uptime))
+
+def mergeHistograms(values):
+    histogram = {}
+    for value in values:
+        for bucket, (count, total) in value.iteritems():
+            dest_count, dest_total = histogram.get(bucket, (0, 0))
+            histogram[bucket] = (dest_count + count, dest_total + total)
+    return histogram
+
+def combine(key, values, context):
+    context.write(key, mergeHistograms(values))
 
 def reduce(key, values, context):
     if not values:
         return
-    lower, upper = mapreduce_common.estQuantile(values, 4)
-    median = int(round(mapreduce_common.estQuantile(values, 2)[0]))
+    histogram = mergeHistograms(values)
+    counts = {bucket: count for bucket, (count, total)
+              in histogram.iteritems()}
+    lower, upper = mapreduce_common.estHistogramQuantile(counts, 4)
+    median = int(round(mapreduce_common.estHistogramQuantile(counts, 2)[0]))
     lower = int(round(lower))
     upper = int(round(upper))
     context.write(json.dumps(key, separators=(',', ':')), json.dumps((
-        len(values), sum(values), (lower, median, upper)
+        sum(counts.itervalues()),
+        sum(total for count, total in histogram.itervalues()),
+        (lower, median, upper)
     ), separators=(',', ':')))
@@ -74,7 +74,7 @@ def map(slug, dims, value, context):
     context.write((key_thread, tuple(key_stack)), (
         dims + [slug],
         mapreduce_common.filterDimensions(
-            dims, mapreduce_common.filterInfo(anr.rawData['info'])),
+            dims, mapreduce_common.cachedInfo(anr.rawData['info'])),
         value))
 
 def reduce(key, values, context):
@@ -97,6 +97,12 @@ def reduce(key, values, context):
                 counts[infovalue] = counts.get(infovalue, 0) + 1
         slugs.append(slug)
 
+    for diminfos in out_info.itervalues():
+        for diminfo in diminfos.itervalues():
+            for infokey, counts in diminfo.iteritems():
+                diminfo[infokey] = mapreduce_common.capInfoValues(
+                    infokey, counts)
+
     key_thread = key[0]
 
     def filterThreadName(name):
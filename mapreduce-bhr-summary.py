@@ -5,5 +5,11 @@ mapreduce_anr_summary = __import__("mapreduce-anr-summary")
 mapreduce_common.allowed_infos = mapreduce_common.allowed_infos_bhr
 mapreduce_common.allowed_dimensions = mapreduce_common.allowed_dimensions_bhr
 
-map = mapreduce_anr_summary.map
+def map(slug, dims, value, context):
+    # per-stratum ping counts, used by fetchbhr to plan sampling rates
+    context.write(("stratum", mapreduce_common.samplingStratum(dims)),
+                  mapreduce_anr_summary.summaryValue(1))
+    mapreduce_anr_summary.map(slug, dims, value, context)
+
+combine = mapreduce_anr_summary.combine
 reduce = mapreduce_anr_summary.reduce
@@ -1,11 +1,13 @@
 import __builtin__
+import hashlib
 import itertools
 import mapreduce_common
 import math
 import re
 import simplejson as json
 import datetime
-import uuid
+import os
+import sys
 
 mapreduce_common.allowed_infos = mapreduce_common.allowed_infos_bhr
 mapreduce_common.allowed_dimensions = mapreduce_common.allowed_dimensions_bhr
@@ -22,11 +24,24 @@ else:
 
 SKIP = 0
 FILTER_LIMIT = 10
+# hangs with fewer submissions are dropped by data_reduce
+MIN_SUBMISSIONS = 10
 
 RE_LINE = re.compile(r':\d+$')
 RE_ADDR = re.compile(r':0x[\da-f]+$', re.IGNORECASE)
 RE_THREAD_NAME_NUM = re.compile(r'[^a-zA-Z]*\d+$')
 
+# The same frames and thread names recur across most pings,
+# so their normalized forms are cached for the life of the process.
+FRAME_CACHE_SIZE = 1 << 16
+THREAD_NAME_CACHE_SIZE = 1 << 10
+FILTER_FRAME_CACHE = mapreduce_common.LRUCache(FRAME_CACHE_SIZE)
+FORMAT_FRAME_CACHE = mapreduce_common.LRUCache(FRAME_CACHE_SIZE)
+THREAD_NAME_CACHE = mapreduce_common.LRUCache(THREAD_NAME_CACHE_SIZE)
+# Mappers have no end-of-input hook, so cache statistics are logged to
+# stderr after this many pings, and again each time the count doubles.
+CACHE_STATS_PINGS = 1000
+
 ARCH_PRIO = 'armv7 x86-64 x86'
 # Treat Darwin, Linux, Android as having same priority,
 # because they have similar telemetry submission rates.
@@ -41,13 +56,29 @@ with open('summary.txt', 'r') as f:
         stats = json.loads(stats)
         SUMMARY.setdefault(info[0], {})[info[1]] = stats[-1]
 
+# Per-stratum sampling rates written by fetchbhr; without a sampling
+# file, fall back to uniformly keeping one in every SKIP + 1 pings.
+SAMPLING = None
+if os.path.exists('sampling.txt'):
+    with open('sampling.txt', 'r') as f:
+        SAMPLING = json.load(f)
+
 if PASS != FILTER_PASS:
     FILTER = {}
+    # stacks whose upper bound on submissions in the data pass reaches
+    # MIN_SUBMISSIONS; stacks below it are not kept at all
+    SUBMITTED = set()
+    has_submissions = False
     with open('filter.txt', 'r') as f:
         for line in f:
             key, sep, val = line.partition('\t')
             dim_key, dim_val = json.loads(key)
             count, name, stack = json.loads(val)
+            if dim_key is None:
+                has_submissions = True
+                if count >= MIN_SUBMISSIONS:
+                    SUBMITTED.add((name, tuple(stack)))
+                continue
             counts = FILTER.setdefault(dim_key, {}).setdefault(dim_val, set())
             if len(counts) >= FILTER_LIMIT:
                 mincount = min(counts, key=lambda x: x[0])
@@ -55,6 +86,15 @@ if PASS != FILTER_PASS:
                     continue
                 counts.remove(mincount)
             counts.add((count, (name, tuple(stack))))
+    # Stacks that cannot reach MIN_SUBMISSIONS would only be dropped by
+    # data_reduce, so don't map them at all. Older filter files have no
+    # submission counts and keep every stack.
+    if has_submissions:
+        for dim_vals in FILTER.itervalues():
+            for dim_val, counts in dim_vals.iteritems():
+                dim_vals[dim_val] = set(
+                    count for count in counts if count[1] in SUBMITTED)
+    del SUBMITTED, has_submissions
 
 # Cut off reports from before 12 weeks (two releases) ago.
 BUILDID_CUTOFF = (
@@ -67,8 +107,80 @@ def log(x):
 def invlog(x):
     return int(round(math.exp(x) - 1))
 
+def _filterFrame(frame):
+    return RE_LINE.sub('', str(frame))
+
+def filterFrame(frame):
+    return FILTER_FRAME_CACHE.get(frame, _filterFrame)
+
+def _filterThreadName(name):
+    return RE_THREAD_NAME_NUM.sub('', str(name))
+
+def filterThreadName(name):
+    return THREAD_NAME_CACHE.get(name, _filterThreadName)
+
+def revisionSuffix(raw_info):
+    if 'revision' not in raw_info:
+        return None
+    parts = raw_info['revision'].split('/')
+    if len(parts) < 3:
+        return None
+    return ' (mxr:' + parts[-3] + ':' + parts[-1] + ')'
+
+def _formatFrame(key):
+    frame, suffix = key
+    if RE_ADDR.search(frame):
+        return 'c:' + frame
+    if ':' not in frame or suffix is None:
+        return 'p:' + frame
+    return 'p:' + frame + suffix
+
+def formatFrame(frame, suffix):
+    return FORMAT_FRAME_CACHE.get((frame, suffix), _formatFrame)
+
+def cacheStats():
+    stats = {
+        'filterFrame': FILTER_FRAME_CACHE.stats(),
+        'formatFrame': FORMAT_FRAME_CACHE.stats(),
+        'filterThreadName': THREAD_NAME_CACHE.stats(),
+        'info': mapreduce_common.infoCacheStats(),
+    }
+    for cache in stats.itervalues():
+        lookups = cache['hits'] + cache['misses']
+        cache['hitRate'] = (round(float(cache['hits']) / lookups, 4)
+                            if lookups else None)
+    return stats
+
+_mapped_pings = 0
+_stats_pings = CACHE_STATS_PINGS
+
+def logCacheStats():
+    global _mapped_pings, _stats_pings
+    _mapped_pings += 1
+    if _mapped_pings < _stats_pings:
+        return
+    _stats_pings *= 2
+    sys.stderr.write('%s cache stats after %d pings: %s\n' % (
+        'BHR filter pass' if PASS == FILTER_PASS else 'BHR data pass',
+        _mapped_pings,
+        json.dumps(cacheStats(), sort_keys=True, separators=(',', ':'))))
+
+def samplingWeight(raw_key, raw_dims):
+    if SAMPLING is None:
+        if SKIP > 0 and (hash(raw_key) % (SKIP + 1)) != 0:
+            return None
+        return SKIP + 1
+    rate = SAMPLING.get(mapreduce_common.samplingStratum(raw_dims), 1.0)
+    if rate >= 1.0:
+        return 1
+    if (hash(raw_key) & 0xffffffff) >= rate * 0x100000000:
+        return None
+    return 1.0 / rate
+
 def map(raw_key, raw_dims, raw_value, cx):
-    if SKIP > 0 and (hash(raw_key) % (SKIP + 1)) != 0:
+    logCacheStats()
+    weight = samplingWeight(raw_key, raw_dims)
+    if not weight:
         return
     if '"threadHangStats":' not in raw_value:
         return
@@ -76,11 +188,11 @@ def map(raw_key, raw_dims, raw_value, cx):
         j = json.loads(raw_value)
         raw_sm = j['simpleMeasurements']
         raw_info = j['info']
-        map_ping(j, raw_dims, raw_sm, raw_info, cx)
+        map_ping(j, raw_dims, raw_sm, raw_info, cx, weight)
     except KeyError:
         return
 
-def map_ping(j, raw_dims, raw_sm, raw_info, cx):
+def map_ping(j, raw_dims, raw_sm, raw_info, cx, weight=SKIP + 1):
     try:
         uptime = raw_sm['uptime']
 
@@ -94,13 +206,18 @@ def map_ping(j, raw_dims, raw_sm, raw_info, cx):
         info = mapreduce_common.filterInfo(raw_info)
         mapreduce_common.addUptime(info, j)
         dims = mapreduce_common.filterDimensions(raw_dims, info)
+
+        # dimensions whose summary uptime range includes this ping;
+        # e10s child payloads share the parent's info, dims and uptime.
+        uptime_dims = {
+            dim_key: dim_val
+            for dim_key, dim_val in dims.iteritems()
+            if (uptime >= SUMMARY[dim_key][dim_val][0] and
+                uptime <= SUMMARY[dim_key][dim_val][-1])
+        }
     except KeyError:
         return
 
-    def filterFrame(frame):
-        frame = RE_LINE.sub('', str(frame))
-        return frame
-
     FRAME_BLACKLIST = [
         'js::RunScript',
     ]
@@ -109,12 +226,12 @@ def map_ping(j, raw_dims, raw_sm, raw_info, cx):
         return (filterFrame(x[0]) for x in itertools.groupby(
                 f for f in stack if f not in FRAME_BLACKLIST))
 
-    def collectData(dims, info, data):
+    def collectData(info, data):
         if isinstance(data, dict):
-            data = {k: v * (SKIP + 1) for k, v in data.iteritems()
+            data = {k: v * weight for k, v in data.iteritems()
                     if v and k.isdigit()}
         else:
-            data = {log(data): SKIP + 1}
+            data = {log(data): weight}
         return (1, {
             dim_key: {
                 dim_val: {
@@ -124,25 +241,14 @@ def map_ping(j, raw_dims, raw_sm, raw_info, cx):
                     for info_key, info_val in info.iteritems()
                 }
             }
-            for dim_key, dim_val in dims.iteritems()
-            if (uptime >= SUMMARY[dim_key][dim_val][0] and
-                uptime <= SUMMARY[dim_key][dim_val][-1])
+            for dim_key, dim_val in uptime_dims.iteritems()
         })
-    collectedUptime = collectData(dims, info, uptime)
+    collectedUptime = collectData(info, uptime)
+
+    revision = revisionSuffix(raw_info)
 
     def formatStack(stack):
-        for frame in reversed(stack):
-            if RE_ADDR.search(frame):
-                yield 'c:' + frame
-                continue
-            if ':' not in frame:
-                yield 'p:' + frame
-                continue
-            if 'revision' not in raw_info:
-                yield 'p:' + frame
-                continue
-            parts = raw_info['revision'].split('/')
-            yield 'p:' + frame + ' (mxr:' + parts[-3] + ':' + parts[-1] + ')'
+        return (formatFrame(frame, revision) for frame in reversed(stack))
 
     def collectStack(dims, info, name, hang):
         return (
@@ -166,69 +272,92 @@ def map_ping(j, raw_dims, raw_sm, raw_info, cx):
             if 'nativeStack' in hang else None
         )
 
-    def filterThreadName(name):
-        name = RE_THREAD_NAME_NUM.sub('', str(name))
-        return name
-
     if PASS == FILTER_PASS:
-        for thread in j['threadHangStats']:
-            name = filterThreadName(thread['name'])
-            for hang in thread['hangs']:
-                if not hang['stack']:
-                    continue
-                for dim_key, dim_val in dims.iteritems():
-                    if (uptime < SUMMARY[dim_key][dim_val][0] or
-                        uptime > SUMMARY[dim_key][dim_val][-1]):
+        def filter_payload(payload, ranked):
+            for thread in payload['threadHangStats']:
+                name = filterThreadName(thread['name'])
+                for hang in thread['hangs']:
+                    if not hang['stack']:
+                        continue
+                    stack = tuple(filterStack(hang['stack']))
+                    # every hang the data pass could map for this stack
+                    cx.write((None, None, name, stack), 1)
+                    if not ranked or not uptime_dims:
                         continue
                     count = hang['histogram']['values']
-                    count = (sum(v * (SKIP + 1) for k, v in count.iteritems()
-                                                if v and k.isdigit())
-                             if isinstance(count, dict) else count * (SKIP + 1))
-                    cx.write((dim_key, dim_val,
-                              name, tuple(filterStack(hang['stack']))), count)
+                    count = (sum(v * weight for k, v in count.iteritems()
+                                            if v and k.isdigit())
+                             if isinstance(count, dict) else count * weight)
+                    for dim_key, dim_val in uptime_dims.iteritems():
+                        cx.write((dim_key, dim_val, name, stack), count)
+
+        # only the parent's hangs are ranked
+        filter_payload(j, True)
+        for child in j.get('childPayloads') or ():
+            if 'threadHangStats' in child:
+                filter_payload(child, False)
         return
 
     assert PASS == DATA_PASS
 
-    for thread in j['threadHangStats']:
-        name = filterThreadName(thread['name'])
-        cx.write((name, None),
-                 collectData(dims, info, thread['activity']['values']))
-        for hang in thread['hangs']:
-            if not hang['stack']:
-                continue
+    # stacks that made the filter pass for any of this ping's dimensions
+    filtered_stacks = set(count[-1]
+                          for dim_key, dim_val in dims.iteritems()
+                          if dim_val in FILTER.get(dim_key, {})
+                          for count in FILTER[dim_key][dim_val])
 
-            stack = (name, tuple(filterStack(hang['stack'])))
+    def map_payload(payload):
+        for thread in payload['threadHangStats']:
+            name = filterThreadName(thread['name'])
+            cx.write((name, None),
+                     collectData(info, thread['activity']['values']))
+            for hang in thread['hangs']:
+                if not hang['stack']:
+                    continue
 
-            if not any(stack == count[-1]
-                       for dim_key, dim_val in dims.iteritems()
-                       if dim_val in FILTER.get(dim_key, {})
-                       for count in FILTER[dim_key][dim_val]):
-                continue
+                stack = (name, tuple(filterStack(hang['stack'])))
 
-            cx.write(stack,
-                     collectData(dims, info, hang['histogram']['values']) +
-                     (collectStack(dims, info, name, hang),))
+                if stack not in filtered_stacks:
+                    continue
+
+                cx.write(stack,
+                         collectData(info, hang['histogram']['values']) +
+                         (collectStack(dims, info, name, hang),))
+
+            cx.write((None, name), collectedUptime)
 
-        cx.write((None, name), collectedUptime)
+        if payload['threadHangStats']:
+            cx.write((None, None), collectedUptime)
 
-    if j['threadHangStats']:
-        cx.write((None, None), collectedUptime)
+    map_payload(j)
 
     if j.get('childPayloads'):
         # process e10s child telemetry pings
         for child in j['childPayloads']:
-            map_ping(child, raw_dims, raw_sm, raw_info, cx)
+            if 'threadHangStats' not in child:
+                continue
+            map_payload(child)
 
 def filter_combine(raw_key, raw_values, cx):
     cx.write(raw_key, sum(raw_values))
 
+def roundCount(count):
+    # sampled counts are weighted by 1 / rate, so they are estimates
+    # that are only written out as whole numbers
+    return int(round(count))
+
+def roundCounts(histograms):
+    if isinstance(histograms, dict):
+        return {k: roundCounts(v) for k, v in histograms.iteritems()}
+    return roundCount(histograms)
+
 def filter_reduce(raw_key, raw_values, cx):
     if not raw_values:
         return
 
     cx.write(json.dumps(raw_key[:2], separators=(',', ':')),
-             json.dumps((sum(raw_values),) + raw_key[2:], separators=(',', ':')))
+             json.dumps((roundCount(sum(raw_values)),) + raw_key[2:],
+                        separators=(',', ':')))
 
 def data_do_combine(raw_key, raw_values):
     def merge_dict(left, right):
@@ -327,15 +456,36 @@ def data_do_combine(raw_key, raw_values):
                 merge_dict(left[1], right[1]),
                 merge_stack(left[2], right[2]))
 
-    return raw_key, __builtin__.reduce(merge, raw_values)
+    def merge_histogram(left, right):
+        return merge_dict(dict(left), right)
+
+    def cap_info(histograms):
+        for dim_vals in histograms.itervalues():
+            for info_keys in dim_vals.itervalues():
+                for info_key, info_vals in info_keys.iteritems():
+                    info_keys[info_key] = mapreduce_common.capInfoValues(
+                        info_key, info_vals,
+                        weight=lambda histogram: sum(histogram.itervalues()),
+                        merge=merge_histogram)
+
+    value = __builtin__.reduce(merge, raw_values)
+    cap_info(value[1])
+    return raw_key, value
 
 def data_combine(raw_key, raw_values, cx):
     key, value = data_do_combine(raw_key, raw_values)
     cx.write(key, value)
 
+def stackSlug(name, stack):
+    # stable across runs, so that outputs of different runs can be compared
+    return hashlib.sha1(json.dumps([name, stack], separators=(',', ':'))
+                        ).hexdigest()[:32]
+
 def data_reduce(raw_key, raw_values, cx):
+    # the first item of each value counts submissions without sampling
+    # weights, so MIN_SUBMISSIONS applies to actual submissions
     if (not raw_values or
-        sum(x[0] for x in raw_values) < 10):
+        sum(x[0] for x in raw_values) < MIN_SUBMISSIONS):
         return
 
     key, value = data_do_combine(raw_key, raw_values)
@@ -354,10 +504,11 @@ def data_reduce(raw_key, raw_values, cx):
     if key[0] is None:
         sumUptimes(value[1], 10)
     elif key[1] is not None:
-        key = (key[0], str(uuid.uuid4()))
+        key = (key[0], stackSlug(*key))
 
     cx.write(json.dumps(key, separators=(',', ':')),
-             json.dumps(value[1:], separators=(',', ':')))
+             json.dumps((roundCounts(value[1]),) + tuple(value[2:]),
+                        separators=(',', ':')))
 
 if PASS == FILTER_PASS:
     combine = filter_combine
@@ -0,0 +1,17 @@
+import imp, os
+import mapreduce_common
+
+# Runs the job given by the PARTIAL_JOB environment variable, but writes
+# its combined values instead of reducing them, so that the outputs of
+# separate runs can later be merged and reduced by fetchanr.mergePartials.
+
+job = imp.load_source('partial_job', os.environ['PARTIAL_JOB'])
+
+map = job.map
+if hasattr(job, 'combine'):
+    combine = job.combine
+
+def reduce(key, values, context):
+    for k, v in mapreduce_common.combineValues(job, key, values).iteritems():
+        context.write(mapreduce_common.encodePartial(k),
+                      mapreduce_common.encodePartial(v))
@@ -1,8 +1,11 @@
-import math
+from bisect import bisect_left
+import base64, marshal, math
 
 allowed_infos = None
 allowed_dimensions = None
 
+_MISSING = object()
+
 allowed_infos_anr = [
     'appUpdateChannel',
     'appVersion',
@@ -84,9 +87,10 @@ def addUptime(info, ping):
 
 MEMSIZES = [(int((1 << n) * (mult + 0.25)), int((1 << n) * mult))
     for n in range(7, 30) for mult in (1, 1.5)]
+MEMSIZE_BOUNDS = [bound for bound, size in MEMSIZES]
 
 def roundMemSize(n):
-    out = next(size for bound, size in MEMSIZES if bound >= n)
+    out = MEMSIZES[bisect_left(MEMSIZE_BOUNDS, n)][1]
     if out < 1024:
         return str(out) + 'M'
     if out > 1024 and out < 2048:
@@ -150,15 +154,146 @@ def adjustInfo(info):
     if 'appBuildID' in info and 'appVersion' in info:
         info['appBuildID'] = info['appVersion'] + '-' + info['appBuildID']
 
-def filterInfo(raw_info):
-    adjustInfo(raw_info)
-    return {k: (raw_info[k]
-                if (k in raw_info and raw_info[k] is not None)
+# raw info fields read by adjustInfo, in addition to allowed_infos
+ADJUST_INFO_FIELDS = [
+    'appUpdateChannel',
+    'appName',
+    'appVersion',
+    'appBuildID',
+    'memsize',
+    'cpucount',
+    'OS',
+    'version',
+    'adapterRAM',
+    'arch',
+    'hasARMv7',
+]
+
+class LRUCache(object):
+    # Approximate LRU cache built from two generations of plain dicts, so a
+    # hit costs about as much as a dict lookup. Once the current generation
+    # holds `size` entries it becomes the old generation; entries not used
+    # since then are dropped at the next turnover.
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._new = {}
+        self._old = {}
+
+    def get(self, key, compute):
+        try:
+            value = self._new[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        value = self._old.pop(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            value = compute(key)
+        else:
+            self.hits += 1
+        if len(self._new) >= self.size:
+            self._old = self._new
+            self._new = {}
+        self._new[key] = value
+        return value
+
+    def clear(self):
+        self._new = {}
+        self._old = {}
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._new) + len(self._old),
+        }
+
+INFO_CACHE_SIZE = 4096
+
+class FrozenInfo(dict):
+    # shared between pings, so it must never be modified;
+    # copy with dict() before adding to it or writing it out
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenInfo is immutable')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+_info_cache = LRUCache(INFO_CACHE_SIZE)
+_info_fields = (None, ())
+
+def _infoFields():
+    global _info_fields
+    if _info_fields[0] is not allowed_infos:
+        _info_cache.clear()
+        _info_fields = (allowed_infos, tuple(
+            sorted(set(ADJUST_INFO_FIELDS).union(allowed_infos))))
+    return _info_fields[1]
+
+def _filterAdjustedInfo(info):
+    return {k: (info[k]
+                if (k in info and info[k] is not None)
                 else 'unknown')
             for k in allowed_infos}
+
+def _adjustedInfo(raw_info):
+    info = dict(raw_info)
+    adjustInfo(info)
+    return FrozenInfo(_filterAdjustedInfo(info))
+
+def cachedInfo(raw_info):
+    # Return the filtered info for raw_info as a shared FrozenInfo,
+    # without modifying raw_info. The number of distinct raw info
+    # tuples is small, so results are memoized.
+    key = tuple(raw_info.get(k, _MISSING) for k in _infoFields())
+    try:
+        return _info_cache.get(key, lambda key: _adjustedInfo(raw_info))
+    except TypeError:
+        # unhashable info value; skip the cache
+        return _adjustedInfo(raw_info)
+
+def infoCacheStats():
+    return _info_cache.stats()
+
+def filterInfo(raw_info):
+    return dict(cachedInfo(raw_info))
     # return {k: v for k, v in raw_info.iteritems()
     #         if k in allowed_infos}
 
+# Most distinct values of an info key kept in aggregates; the rest are
+# folded into OTHER_INFO_VALUE. INFO_VALUE_LIMITS overrides the default
+# for individual info keys, and a limit of None keeps every value.
+DEFAULT_INFO_VALUE_LIMIT = 100
+INFO_VALUE_LIMITS = {}
+OTHER_INFO_VALUE = ''
+
+def capInfoValues(info_key, info_vals, weight=None, merge=None):
+    # Keep the heaviest values of info_key in info_vals, a dict of info
+    # value -> count, and fold the rest into OTHER_INFO_VALUE. weight and
+    # merge handle values other than plain counts. Folded values keep their
+    # counts, so capped aggregates can still be merged and capped again.
+    limit = INFO_VALUE_LIMITS.get(info_key, DEFAULT_INFO_VALUE_LIMIT)
+    if limit is None or len(info_vals) <= limit:
+        return info_vals
+    weight = weight or (lambda count: count)
+    merge = merge or (lambda left, right: left + right)
+    ranked = sorted((val for val in info_vals if val != OTHER_INFO_VALUE),
+                    key=lambda val: (-weight(info_vals[val]), val))
+    capped = {val: info_vals[val] for val in ranked[:limit]}
+    other = info_vals.get(OTHER_INFO_VALUE)
+    for val in ranked[limit:]:
+        other = (info_vals[val] if other is None
+                 else merge(other, info_vals[val]))
+    capped[OTHER_INFO_VALUE] = other
+    return capped
+
+def samplingStratum(raw_dims):
+    return (raw_dims[dimensions.index('appName')] + '/' +
+            raw_dims[dimensions.index('appUpdateChannel')])
+
 def filterDimensions(raw_dims, raw_info):
     return {dim: (raw_dims[dimensions.index(dim)]
                   if dim not in raw_info else raw_info[dim])
@@ -170,8 +305,13 @@ def estQuantile(values, n, key=lambda x:x):
     for x in (key(v) for v in values):
         k = round(math.log(x + offset), 2)
         histograms[k] = histograms.get(k, 0) + 1
+    return estHistogramQuantile(histograms, n, offset)
+
+def estHistogramQuantile(histograms, n, offset=1):
+    # histograms maps round(log(x + offset), 2) to the count of x values
+    total = sum(histograms.itervalues())
     def _est(keys):
-        need = len(values) / n
+        need = total / n
         for k in keys:
             count = histograms[k]
             if need <= count:
@@ -196,3 +336,26 @@ def quantile(values, n, upper=True, key=lambda x:x):
         curidx, curmin = (min(enumerate(maxs), key=lambda x:x[1]) if upper else
                           max(enumerate(maxs), key=lambda x:x[1]))
     return curmin
+
+def encodePartial(obj):
+    # partial job output has to survive the tab-separated output format
+    return base64.b64encode(marshal.dumps(obj))
+
+def decodePartial(data):
+    return marshal.loads(base64.b64decode(data))
+
+class _CombineContext:
+    def __init__(self):
+        self.values = {}
+
+    def write(self, key, value):
+        self.values.setdefault(key, []).append(value)
+
+def combineValues(job, key, values):
+    # Merge values with the combine function of the job module, returning a
+    # dict of key -> values. Jobs without combine keep every value.
+    if not hasattr(job, 'combine') or len(values) < 2:
+        return {key: values}
+    cx = _CombineContext()
+    job.combine(key, values, cx)
+    return cx.values
@@ -4,34 +4,238 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os, struct, tempfile, zlib
+from array import array
+from bisect import bisect_right
+
+class GzipMemberReader:
+    # Sequential reader of the decompressed data of a gzip file, starting
+    # at the beginning of one of its members.
+
+    _CHUNK = 1 << 20
+
+    def __init__(self, f, offset, pos):
+        f.seek(offset)
+        self._f = f
+        self._buf = ''
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # uncompressed offset of the next byte returned by read()
+        self.pos = pos
+
+    def _inflate(self):
+        data = self._f.read(self._CHUNK)
+        if not data:
+            return self._inflater.flush()
+        out = []
+        while data:
+            out.append(self._inflater.decompress(data))
+            data = self._inflater.unused_data
+            if data:
+                # the member ended; the rest of the input starts the next one
+                self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return ''.join(out)
+
+    def read(self, size):
+        while len(self._buf) < size:
+            data = self._inflate()
+            if not data:
+                break
+            self._buf += data
+        out, self._buf = self._buf[:size], self._buf[size:]
+        self.pos += len(out)
+        return out
+
+    def skip(self, size):
+        while size > len(self._buf):
+            size -= len(self._buf)
+            self.pos += len(self._buf)
+            self._buf = self._inflate()
+            if not self._buf:
+                return
+        self._buf = self._buf[size:]
+        self.pos += size
+
+class LineIndex:
+    # Offsets of the lines of a file with one report per line, which may be
+    # gzipped. The index is saved next to the file, so that later runs can
+    # go straight to the requested lines. For gzipped files, offsets are
+    # into the decompressed data, and the index also records where gzip
+    # members start, so reading resumes from the closest preceding member.
+    # Python's zlib cannot resume inflating in the middle of a member, so a
+    # single-member file is still decompressed from its start.
+    #
+    # Index layout (native byte order and word size):
+    #     header: magic, file mtime and size, number of lines and members
+    #     lines: start offset of every line, followed by the end offset
+    #     members: compressed and decompressed start offset of each member
+
+    _MAGIC = 'ANRLNIX1'
+    _HEADER = struct.Struct('=8sdQQQ')
+    _EXT = '.lidx'
+    _CHUNK = 1 << 20
+    # members are only recorded this many decompressed bytes apart
+    _MEMBER_SPACING = 1 << 20
+
+    def __init__(self, path):
+        self._path = path
+        stat = os.stat(path)
+        self._key = (stat.st_mtime, stat.st_size)
+        with open(path, 'rb') as f:
+            self._gzipped = f.read(2) == '\x1f\x8b'
+        if not self._loadIndex():
+            self._buildIndex()
+            self._saveIndex()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _loadIndex(self):
+        try:
+            with open(self._path + self._EXT, 'rb') as f:
+                buf = f.read()
+        except (IOError, OSError):
+            return False
+        if len(buf) < self._HEADER.size:
+            return False
+        magic, mtime, size, nlines, nmembers = self._HEADER.unpack_from(buf, 0)
+        if magic != self._MAGIC or (mtime, size) != self._key:
+            return False
+        tables = [array('L') for i in range(3)]
+        offset = self._HEADER.size
+        for table, count in zip(tables, [nlines + 1] + [nmembers] * 2):
+            end = offset + count * table.itemsize
+            if end > len(buf):
+                return False
+            table.fromstring(buf[offset:end])
+            offset = end
+        self._offsets, self._memberOffsets, self._memberPos = tables
+        return True
+
+    def _inflate(self, f):
+        # decompressed data of every member, recording where members start
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        consumed = 0
+        produced = 0
+        for data in iter(lambda: f.read(self._CHUNK), ''):
+            consumed += len(data)
+            while data:
+                out = inflater.decompress(data)
+                produced += len(out)
+                yield out
+                data = inflater.unused_data
+                if data:
+                    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    if produced - self._memberPos[-1] >= self._MEMBER_SPACING:
+                        self._memberOffsets.append(consumed - len(data))
+                        self._memberPos.append(produced)
+        yield inflater.flush()
+
+    def _buildIndex(self):
+        self._offsets = array('L', [0])
+        self._memberOffsets = array('L')
+        self._memberPos = array('L')
+        pos = 0
+        with open(self._path, 'rb') as f:
+            if self._gzipped:
+                self._memberOffsets.append(0)
+                self._memberPos.append(0)
+                chunks = self._inflate(f)
+            else:
+                chunks = iter(lambda: f.read(self._CHUNK), '')
+            for chunk in chunks:
+                start = chunk.find('\n')
+                while start >= 0:
+                    self._offsets.append(pos + start + 1)
+                    start = chunk.find('\n', start + 1)
+                pos += len(chunk)
+        if self._offsets[-1] != pos:
+            # last line without a newline
+            self._offsets.append(pos)
+
+    def _saveIndex(self):
+        dirname = os.path.dirname(os.path.abspath(self._path))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix=self._EXT)
+        except (IOError, OSError):
+            # read-only directory; keep the index in memory
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._HEADER.pack(self._MAGIC,
+                                          self._key[0], self._key[1],
+                                          len(self), len(self._memberPos)))
+                for table in (self._offsets,
+                              self._memberOffsets, self._memberPos):
+                    f.write(table.tostring())
+            os.rename(tmp, self._path + self._EXT)
+        except (IOError, OSError):
+            os.remove(tmp)
+
+    def readLines(self, numbers):
+        # yields (number, line) for the requested lines in file order;
+        # line is None for numbers past the end of the file
+        with open(self._path, 'rb') as f:
+            reader = None
+            for number in sorted(set(numbers)):
+                if number < 0 or number >= len(self):
+                    yield number, None
+                    continue
+                start = self._offsets[number]
+                size = self._offsets[number + 1] - start
+                if not self._gzipped:
+                    f.seek(start)
+                    yield number, f.read(size)
+                    continue
+                member = bisect_right(self._memberPos, start) - 1
+                if (reader is None or reader.pos > start or
+                    reader.pos < self._memberPos[member]):
+                    reader = GzipMemberReader(f, self._memberOffsets[member],
+                                              self._memberPos[member])
+                reader.skip(start - reader.pos)
+                yield number, reader.read(size)
+
 if __name__ == '__main__':
 
-    import os, sys
+    import sys
     import simplejson as json
     from anr import ANRReport
 
-    def printLine(l):
-        anr = ANRReport(l)
-        traces = anr.rawData.pop('androidANR', None)
-        logcat = anr.rawData.pop('androidLogcat', None)
-        nativeStack = anr.rawData.pop('androidNativeStack', None)
-        print json.dumps(anr.rawData, indent=4)
+    def printReport(rawData, nativeStack):
+        traces = rawData.pop('androidANR', None)
+        logcat = rawData.pop('androidLogcat', None)
+        rawData.pop('androidNativeStack', None)
+        print json.dumps(rawData, indent=4)
         print '===== raw traces ====='
         print traces
         print '===== end raw traces ====='
         print '===== raw logcat ====='
         print logcat
         print '===== end raw logcat ====='
-        if anr.nativeStack:
+        if nativeStack:
             print '===== raw native stack ====='
-            print json.dumps(anr.nativeStack, indent=4)
+            print (nativeStack if isinstance(nativeStack, basestring)
+                   else json.dumps(nativeStack, indent=4))
             print '===== end raw native stack ====='
 
-    if len(sys.argv) != 3 and len(sys.argv) != 1:
-        print 'Usage %s [<file> <lines>]' % (sys.argv[0])
+    def printLine(l):
+        anr = ANRReport(l)
+        printReport(anr.rawData, anr.nativeStack)
+
+    def printRawLine(l):
+        # only the raw sections, without parsing the report
+        rawData = json.loads(l)
+        printReport(rawData, rawData.get('androidNativeStack'))
+
+    args = sys.argv[1:]
+    if '--raw' in args:
+        args.remove('--raw')
+        printLine = printRawLine
+
+    if len(args) != 2 and len(args) != 0:
+        print 'Usage %s [--raw] [<file> <lines>]' % (sys.argv[0])
         sys.exit(1)
 
-    if len(sys.argv) == 1:
+    if len(args) == 0:
         l = sys.stdin.readline()
         while l:
             print '===== ANR ====='
@@ -41,16 +245,13 @@ if __name__ == '__main__':
             l = sys.stdin.readline()
         sys.exit(0)
 
-    lines = [int(l, 0) for l in sys.argv[2].split(',')]
+    lines = [int(l, 0) for l in args[1].split(',')]
 
-    with open(sys.argv[1], 'r') as f:
-        line = -1
-        for l in f:
-            line += 1
-            if line not in lines:
-                continue
-            print '===== ANR file %s line %d =====' % (
-                os.path.basename(sys.argv[1]), line)
-            printLine(l)
-            print '===== END ANR ====='
-            print
+    for line, l in LineIndex(args[0]).readLines(lines):
+        if l is None:
+            continue
+        print '===== ANR file %s line %d =====' % (
+            os.path.basename(args[0]), line)
+        printLine(l)
+        print '===== END ANR ====='
+        print
@@ -1,6 +1,8 @@
 #!/bin/bash
 START=$1
 END=$2
+# Optional total number of pings to sample; see fetchbhr.py
+BUDGET=$3
 if [ -z "$START" -o -z "$END" ]; then
   # Arguments missing. Default to the previous week
   START=$(date -d 'last saturday - 6 days' +%Y%m%d)
@@ -36,7 +38,7 @@ else
 fi
 
 cd ~/telemetry-server
-python $BASE/hang-telemetry-tools/fetchbhr.py $START $END
+python $BASE/hang-telemetry-tools/fetchbhr.py $START $END $BUDGET
 echo "Job exited with code: $?"
 
 cd -
@@ -4,29 +4,504 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from array import array
 from bisect import bisect
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from datetime import datetime
 import ftplib
+import httplib
+import mmap
+from multiprocessing.pool import ThreadPool
 import os
+import re
+import shutil
+import simplejson as json
+import sqlite3
+import struct
 import subprocess
+import tempfile
+import threading
+import time
+import urlparse
 import zipfile
 
 Symbol = namedtuple("Symbol", "library function source line")
 
+SYMBOLICATOR_CACHE_SIZE = 64
+SYMBOL_FILE_CACHE_SIZE = 256
+SYMBOL_CACHE_ENTRIES = 1 << 20
+PREFETCH_THREADS = 4
+
+# Server to download symbol archives from, as an ftp:// or http(s):// URL,
+# or a bare host name for FTP. 'ftp.mozilla.org' is decommissioned.
+SYMBOL_SERVER = ''
+
+class LRUCache:
+    '''
+    A bounded mapping that evicts the least recently used entry,
+    passing each evicted entry to evict() if given.
+    '''
+
+    def __init__(self, size, evict=None):
+        self._size = size
+        self._evict = evict
+        self._items = OrderedDict()
+
+    def get(self, key, create):
+        '''
+        Return the entry for key, calling create() to make it if missing.
+        '''
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            value = create()
+        self._items[key] = value
+        while len(self._items) > self._size:
+            old = self._items.popitem(last=False)[1]
+            if self._evict:
+                self._evict(old)
+        return value
+
+class SymbolDownloader:
+    '''
+    Downloads symbol archives from an FTP or HTTP server. Each thread keeps
+    its connection open between downloads, and interrupted downloads are
+    resumed from the partial file left behind.
+    '''
+    _CHUNK = 1 << 20
+    _PART_EXT = '.part'
+
+    def __init__(self, server):
+        url = urlparse.urlparse(server if '://' in server else 'ftp://' + server)
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port
+        self._base = url.path.rstrip('/')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn:
+            return conn
+        if self._scheme == 'ftp':
+            conn = ftplib.FTP()
+            conn.connect(self._host, self._port or ftplib.FTP_PORT)
+            conn.login()
+        elif self._scheme == 'http':
+            conn = httplib.HTTPConnection(self._host, self._port)
+        elif self._scheme == 'https':
+            conn = httplib.HTTPSConnection(self._host, self._port)
+        else:
+            raise Exception("Unsupported symbol server")
+        self._local.conn = conn
+        with self._lock:
+            self._conns.append(conn)
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn:
+            with self._lock:
+                self._conns.remove(conn)
+            self._closeConn(conn)
+
+    def _closeConn(self, conn):
+        try:
+            if isinstance(conn, ftplib.FTP):
+                conn.quit()
+            else:
+                conn.close()
+        except (ftplib.all_errors, httplib.HTTPException):
+            pass
+
+    def close(self):
+        '''
+        Close the connections of every thread.
+        '''
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            self._closeConn(conn)
+
+    def _downloadFTP(self, src, part, offset):
+        ftp = self._connect()
+        with open(part, 'ab') as f:
+            ftp.retrbinary('RETR ' + src, f.write, self._CHUNK, offset or None)
+
+    def _downloadHTTP(self, src, part, offset):
+        conn = self._connect()
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        conn.request('GET', src, headers=headers)
+        resp = conn.getresponse()
+        if resp.status == 416 and offset:
+            # the partial file is already complete
+            resp.read()
+            return
+        if resp.status not in (200, 206):
+            resp.read()
+            raise IOError("HTTP error %d" % resp.status)
+        # servers that ignore the range send the whole file again
+        with open(part, 'ab' if resp.status == 206 else 'wb') as f:
+            shutil.copyfileobj(resp, f, self._CHUNK)
+
+    def download(self, path, dst):
+        '''
+        Download the file at path on the server to dst.
+        '''
+        part = dst + self._PART_EXT
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        src = self._base + path
+        try:
+            if self._scheme == 'ftp':
+                self._downloadFTP(src, part, offset)
+            else:
+                self._downloadHTTP(src, part, offset)
+        except:
+            self._disconnect()
+            raise
+        os.rename(part, dst)
+
+class SymbolCache:
+    '''
+    A persistent cache of symbol lookups, keyed by build, device module
+    and address, and shared between processes and runs through sqlite.
+    Lookups only need the build info from the stack, so cached stacks are
+    symbolicated without downloading or opening any symbols. Once the
+    cache holds more than the given number of entries, the least recently
+    used entries are evicted.
+    '''
+    _QUERY_CHUNK = 500
+
+    def __init__(self, path, size=SYMBOL_CACHE_ENTRIES):
+        self._path = path
+        self._size = size
+        self._db = None
+        self._pid = None
+        self._count = 0
+
+    def _connect(self):
+        # sqlite connections must not be shared with forked workers
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self._path, timeout=60)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                # entries used to be keyed by breakpad ID
+                db.execute('DROP TABLE IF EXISTS symbols')
+                db.execute('CREATE TABLE IF NOT EXISTS build_symbols ('
+                           'build TEXT, module TEXT, address INTEGER, '
+                           'library TEXT, function TEXT, source TEXT, '
+                           'line INTEGER, used INTEGER, '
+                           'PRIMARY KEY (build, module, address))')
+                db.execute('CREATE INDEX IF NOT EXISTS build_symbols_used '
+                           'ON build_symbols (used)')
+            # counted once per connection and then kept up to date, so
+            # that storing entries does not need to count the table
+            self._count = db.execute(
+                'SELECT COUNT(*) FROM build_symbols').fetchone()[0]
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def lookup(self, build, addresses):
+        '''
+        Given a build key and a list of (module, address) pairs, return a
+        dict of cached Symbols by pair, with None values for addresses
+        known to have no symbol.
+        '''
+        found = {}
+        modules = {}
+        for module, address in set(addresses):
+            modules.setdefault(module, []).append(address)
+        build = json.dumps(build)
+        try:
+            db = self._connect()
+            for module, module_addresses in modules.iteritems():
+                module_addresses.sort()
+                for i in range(0, len(module_addresses), self._QUERY_CHUNK):
+                    chunk = module_addresses[i:i + self._QUERY_CHUNK]
+                    rows = db.execute(
+                        'SELECT address, library, function, source, line '
+                        'FROM build_symbols WHERE build = ? AND module = ? '
+                        'AND address IN (%s)' % ','.join('?' * len(chunk)),
+                        [build, module] + chunk)
+                    for address, library, function, source, line in rows:
+                        found[(module, address)] = (
+                            Symbol(library, function, source, line)
+                            if function is not None else None)
+            if found:
+                with db:
+                    db.executemany(
+                        'UPDATE build_symbols SET used = ? WHERE build = ? '
+                        'AND module = ? AND address = ?',
+                        ((int(time.time()), build, module, address)
+                         for module, address in found))
+        except sqlite3.Error:
+            pass
+        return found
+
+    def store(self, build, symbols):
+        '''
+        Add a dict of Symbols (or None) by (module, address) to the cache.
+        '''
+        now = int(time.time())
+        build = json.dumps(build)
+        try:
+            db = self._connect()
+            with db:
+                cursor = db.executemany(
+                    'INSERT OR IGNORE INTO build_symbols '
+                    'VALUES (?,?,?,?,?,?,?,?)',
+                    ((build, module, address) +
+                     (tuple(symbol) if symbol else (None,) * 4) + (now,)
+                     for (module, address), symbol in symbols.iteritems()))
+                self._count += max(cursor.rowcount, 0)
+                if self._count > self._size:
+                    # evict a tenth more than needed, so that eviction
+                    # does not run on every store once the cache is full
+                    cursor = db.execute(
+                        'DELETE FROM build_symbols WHERE rowid IN ('
+                        'SELECT rowid FROM build_symbols ORDER BY used '
+                        'LIMIT ?)', (self._count - self._size +
+                                     self._size // 10,))
+                    self._count -= max(cursor.rowcount, 0)
+        except sqlite3.Error:
+            pass
+
+_symbolCache = None
+
+def setSymbolCache(path, size=SYMBOL_CACHE_ENTRIES):
+    '''
+    Use a persistent symbol cache at the given path, or none if path is None.
+    '''
+    global _symbolCache
+    _symbolCache = SymbolCache(path, size) if path else None
+
+class BreakpadSymbolIndex:
+    '''
+    A binary index of the FUNC, line and FILE records in a Breakpad
+    symbol file. The index is stored next to the symbol file and is
+    memory-mapped by later processes, so that lookups do not require
+    parsing the symbol file again.
+
+    Index layout (native byte order):
+        header: magic, breakpad ID, symbol file mtime and size,
+                and the number of funcs, lines, and files
+        funcs:  start, end, name offset, first line, line count
+        lines:  start, end, line number, file index
+        files:  name offset
+        strings: NUL-terminated function and file names
+    '''
+    _MAGIC = 'BPSYMIX1'
+    _HEADER = struct.Struct('=8s64sdQIII')
+    _NO_FILE = 0xffffffff
+    _EXT = '.idx'
+    _LINE_RECORD = re.compile(r'[0-9a-fA-F]+ ')
+
+    class _Table(object):
+        '''
+        A read-only sequence of unsigned ints within a buffer.
+        '''
+        _ITEM = struct.Struct('=I')
+
+        def __init__(self, buf, offset, count):
+            self._buf = buf
+            self._offset = offset
+            self._count = count
+
+        def __len__(self):
+            return self._count
+
+        def __getitem__(self, index):
+            if index < 0:
+                index += self._count
+            if index < 0 or index >= self._count:
+                raise IndexError(index)
+            return self._ITEM.unpack_from(
+                self._buf, self._offset + index * self._ITEM.size)[0]
+
+    def __init__(self, symfile, breakpadId):
+        '''
+        Load the index for the given symbol file, building and saving
+        the index first if it is missing or out of date.
+        '''
+        self._symfile = symfile
+        self._breakpadId = breakpadId
+        stat = os.stat(symfile)
+        self._key = (breakpadId, stat.st_mtime, stat.st_size)
+        self._buf = self._mapIndex() or self._buildIndex()
+        self._initTables()
+
+    @classmethod
+    def indexFile(cls, symfile):
+        return symfile + cls._EXT
+
+    def _checkHeader(self, buf):
+        if len(buf) < self._HEADER.size:
+            return False
+        magic, breakpadId, mtime, size, nfuncs, nlines, nfiles = (
+            self._HEADER.unpack_from(buf, 0))
+        return (magic == self._MAGIC and
+                (breakpadId.rstrip('\0'), mtime, size) == self._key)
+
+    def _mapIndex(self):
+        try:
+            with open(self.indexFile(self._symfile), 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError, mmap.error):
+            return None
+        if not self._checkHeader(buf):
+            buf.close()
+            return None
+        return buf
+
+    def _buildIndex(self):
+        files = {}
+        funcs = []
+        lines = [array('I') for i in range(4)]
+        with open(self._symfile, 'r') as f:
+            inFunc = False
+            for line in f:
+                if inFunc and self._LINE_RECORD.match(line):
+                    start, size, lineno, fileno = line.split(' ', 3)
+                    start = int(start, 0x10)
+                    lines[0].append(start)
+                    lines[1].append(start + int(size, 0x10))
+                    lines[2].append(int(lineno))
+                    lines[3].append(int(fileno))
+                    continue
+                inFunc = False
+                if line.startswith('FILE '):
+                    label, index, source = line.strip().split(' ', 2)
+                    files[int(index)] = source
+                elif line.startswith('FUNC '):
+                    parts = line.strip().split(' ')
+                    if parts[1] == 'm':
+                        parts.pop(1)
+                    label, start, size, stack = parts[:4]
+                    start = int(start, 0x10)
+                    funcs.append((start, start + int(size, 0x10),
+                                  ' '.join(parts[4:]), len(lines[0])))
+                    inFunc = True
+
+        # line records of a func run until the next func in file order
+        firsts = [func[3] for func in funcs[1:]] + [len(lines[0])]
+        funcs = [func + (next - func[3],) for func, next in zip(funcs, firsts)]
+        funcs.sort(key=lambda func: func[0])
+        fileNumbers = sorted(files)
+        fileIndex = {n: i for i, n in enumerate(fileNumbers)}
+        lines[3] = array('I', (fileIndex.get(n, self._NO_FILE)
+                               for n in lines[3]))
+
+        strings = []
+        stringSize = [0]
+        def addString(s):
+            offset = stringSize[0]
+            strings.append(s)
+            stringSize[0] += len(s) + 1
+            return offset
+
+        funcTable = [array('I') for i in range(5)]
+        for start, end, name, first, count in funcs:
+            funcTable[0].append(start)
+            funcTable[1].append(end)
+            funcTable[2].append(addString(name))
+            funcTable[3].append(first)
+            funcTable[4].append(count)
+        fileTable = array('I', (addString(files[n]) for n in fileNumbers))
+
+        header = self._HEADER.pack(self._MAGIC, self._breakpadId,
+                                   self._key[1], self._key[2],
+                                   len(funcs), len(lines[0]), len(files))
+        buf = ''.join([header] +
+                      [t.tostring() for t in funcTable + lines] +
+                      [fileTable.tostring(), '\0'.join(strings), '\0'])
+        self._saveIndex(buf)
+        return buf
+
+    def _saveIndex(self, buf):
+        dirname = os.path.dirname(os.path.abspath(self._symfile))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix=self._EXT)
+        except (IOError, OSError):
+            # read-only symbol directory; keep the index in memory
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf)
+            # rename is atomic, so concurrent readers never see a partial index
+            os.rename(tmp, self.indexFile(self._symfile))
+        except (IOError, OSError):
+            os.remove(tmp)
+
+    def _initTables(self):
+        magic, breakpadId, mtime, size, nfuncs, nlines, nfiles = (
+            self._HEADER.unpack_from(self._buf, 0))
+        offset = self._HEADER.size
+        tables = []
+        for count in [nfuncs] * 5 + [nlines] * 4 + [nfiles]:
+            tables.append(self._Table(self._buf, offset, count))
+            offset += count * self._Table._ITEM.size
+        (self._funcStart, self._funcEnd, self._funcName,
+         self._funcLine, self._funcLines) = tables[0:5]
+        (self._lineStart, self._lineEnd,
+         self._lineNo, self._lineFile) = tables[5:9]
+        self._fileName = tables[9]
+        self._strings = offset
+
+    def _getString(self, offset):
+        start = self._strings + offset
+        return self._buf[start:self._buf.find('\0', start)]
+
+    def getFunc(self, address, lo=0):
+        '''
+        Return the index of the func containing the address, or None.
+        Only funcs at or after index lo are considered.
+        '''
+        index = bisect(self._funcEnd, address, lo)
+        if index == len(self._funcEnd) or address < self._funcStart[0]:
+            return None
+        return index
+
+    def getFuncRecord(self, index):
+        '''
+        Return (start, end, name, line record indices) for a func.
+        '''
+        first = self._funcLine[index]
+        return (self._funcStart[index], self._funcEnd[index],
+                self._getString(self._funcName[index]),
+                xrange(first, first + self._funcLines[index]))
+
+    def getLine(self, index):
+        '''
+        Return (start, end, line number, file index) for a line record.
+        '''
+        return (self._lineStart[index], self._lineEnd[index],
+                self._lineNo[index], self._lineFile[index])
+
+    def getFile(self, index):
+        '''
+        Return the source file name for a file index.
+        '''
+        if index == self._NO_FILE:
+            raise KeyError(index)
+        return self._getString(self._fileName[index])
+
 class BreakpadSymbolFile:
     '''
     A symbolicator targetting Breakpad-format symbol files.
     '''
-    Func = namedtuple("Func", "start end name offset")
+    Func = namedtuple("Func", "start end name lines")
 
     def __init__(self, filename):
         '''
         Create a symbolicator using the given symbol file name.
         '''
         self._filename = filename
-        self._files = {}
-        self._funcs = []
+        self._index = None
         self._initModule()
 
     def _initModule(self):
@@ -71,82 +546,204 @@ class BreakpadSymbolFile:
         '''
         return self._platform
 
-    def _listFiles(self):
+    def _getIndex(self):
         '''
-        Load FILE records in symbol file.
+        Load the FUNC, line and FILE records through the binary index.
         '''
-        if self._files:
-            return
-        with open(self._filename, 'r') as f:
-            line = f.readline()
-            while line:
-                if line.startswith('FILE '):
-                    label, index, source = line.strip().split(' ', 2)
-                    self._files[index] = source
-                # FILE lines tend to be together at the beginning of the
-                # symbol file, so if we found some FILE lines but stopped
-                # seeting them, we can assume there are no more FILE lines.
-                elif self._files:
-                    break
-                line = f.readline()
+        if not self._index:
+            self._index = BreakpadSymbolIndex(self._filename, self._breakpadId)
+        return self._index
 
     def _getFile(self, index):
-        self._listFiles()
-        return self._files[index]
-
-    def _listFuncs(self):
-        '''
-        Load FUNC records in symbol file.
-        '''
-        if self._funcs:
-            return
-        with open(self._filename, 'r') as f:
-            line = f.readline()
-            while line:
-                if line.startswith('FUNC '):
-                    label, start, size, stack, name = line.strip().split(' ', 4)
-                    start = int(start, 0x10)
-                    size = int(size, 0x10)
-                    self._funcs.append(
-                        self.Func(start, start + size, name, f.tell()))
-                line = f.readline()
-
-        self._funcs.sort(key=lambda f: f.start)
-        self._funcKeys = [f.end for f in self._funcs]
+        return self._getIndex().getFile(index)
 
     def _getFunc(self, address):
-        self._listFuncs()
-        index = bisect(self._funcKeys, address)
-        if index == len(self._funcKeys) or address < self._funcs[0].start:
+        index = self._getIndex().getFunc(address)
+        if index is None:
             return None
-        return self._funcs[index]
+        return self.Func(*self._index.getFuncRecord(index))
 
     def symbolicate(self, address):
         '''
         Given an address relative to the library,
         return a Symbol corresponding to that address.
         '''
-        func = self._getFunc(address)
+        return self._symbolicateFunc(self._getFunc(address), address)
+
+    def symbolicate_many(self, addresses):
+        '''
+        Given a list of addresses relative to the library, return a list
+        of corresponding Symbols, or None for addresses that cannot be
+        symbolicated. Addresses are resolved in sorted order in a single
+        forward pass over the index.
+        '''
+        index = self._getIndex()
+        symbols = [None] * len(addresses)
+        lo = 0
+        last = None
+        for i in sorted(range(len(addresses)), key=addresses.__getitem__):
+            address = addresses[i]
+            if last and last[0] == address:
+                symbols[i] = last[1]
+                continue
+            funcIndex = index.getFunc(address, lo)
+            func = None
+            if funcIndex is not None:
+                lo = funcIndex
+                func = self.Func(*index.getFuncRecord(funcIndex))
+            try:
+                symbols[i] = self._symbolicateFunc(func, address)
+            except KeyError:
+                pass
+            last = (address, symbols[i])
+        return symbols
+
+    def _symbolicateFunc(self, func, address):
         if not func:
             return None
 
         # Get filename and line number
-        with open(self._filename, 'r') as f:
-            f.seek(func.offset)
-            line = f.readline()
-            label = line.partition(' ')[0]
-            while all(c in '0123456789abcdefABCDEF' for c in label):
-                start, size, lineno, fileno = line.strip().split(' ', 3)
-                start = int(start, 0x10)
-                size = int(size, 0x10)
-                if address >= start and address < (start + size):
-                    return Symbol(self._library, func.name,
-                                  self._getFile(fileno), int(lineno))
-                line = f.readline()
-                label = line.partition(' ')[0]
+        for line in func.lines:
+            start, end, lineno, fileno = self._index.getLine(line)
+            if address >= start and address < end:
+                return Symbol(self._library, func.name,
+                              self._getFile(fileno), lineno)
 
         return Symbol(self._library, func.name, '(unknown)', 0)
 
+class Addr2LineFile:
+    '''
+    A symbolicator targetting unstripped ARM libraries, using the bundled
+    arm-addr2line. One addr2line process is kept running per library, and
+    addresses are streamed through it in batches.
+    '''
+    _ADDR2LINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'arm-addr2line')
+    _BATCH = 64
+
+    def __init__(self, filename):
+        '''
+        Create a symbolicator using the given library file name.
+        '''
+        self._filename = filename
+        self._library = os.path.basename(filename)
+        self._proc = None
+
+    @property
+    def library(self):
+        '''
+        The name of the library.
+        '''
+        return self._library
+
+    def _start(self):
+        if self._proc and self._proc.poll() is None:
+            return self._proc
+        with open(os.devnull, 'w') as devnull:
+            self._proc = subprocess.Popen(
+                [self._ADDR2LINE, '-f', '-C', '-e', self._filename],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull)
+        return self._proc
+
+    def close(self):
+        '''
+        Stop the addr2line process.
+        '''
+        if self._proc:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc = None
+
+    def _parse(self, function, location):
+        function = function.strip()
+        if not function or function == '??':
+            return None
+        source, sep, line = location.strip().partition(' ')[0].rpartition(':')
+        if source == '??':
+            source = ''
+        return Symbol(self._library, function, source,
+                      int(line) if line.isdigit() else 0)
+
+    def symbolicate(self, address):
+        '''
+        Given an address relative to the library,
+        return a Symbol corresponding to that address.
+        '''
+        return self.symbolicate_many([address])[0]
+
+    def symbolicate_many(self, addresses):
+        '''
+        Given a list of addresses relative to the library, return a list
+        of corresponding Symbols, or None for addresses that cannot be
+        symbolicated.
+        '''
+        symbols = []
+        try:
+            proc = self._start()
+            # addr2line answers each address with a function line and
+            # a location line; batches keep the pipes from filling up.
+            for i in range(0, len(addresses), self._BATCH):
+                batch = addresses[i:i + self._BATCH]
+                proc.stdin.write(''.join('0x%x\n' % a for a in batch))
+                proc.stdin.flush()
+                for address in batch:
+                    function = proc.stdout.readline()
+                    location = proc.stdout.readline()
+                    if not location:
+                        raise IOError("addr2line exited")
+                    symbols.append(self._parse(function, location))
+        except (IOError, OSError):
+            self.close()
+        return symbols + [None] * (len(addresses) - len(symbols))
+
+class Addr2LineSymbolicator:
+    '''
+    A symbolicator for builds with unstripped libraries in a local
+    directory, with the same interface as Symbolicator.
+    '''
+
+    def __init__(self, libdir):
+        self._libdir = libdir
+        self._libs = {}
+
+    def _getLibrary(self, module):
+        name = module.split('/')[-1]
+        if name not in self._libs:
+            path = os.path.join(self._libdir, name)
+            self._libs[name] = Addr2LineFile(path) if os.path.isfile(path) else None
+        return self._libs[name]
+
+    def symbolicate(self, module, address):
+        lib = self._getLibrary(module)
+        if not lib:
+            raise Exception("Cannot find module")
+        return lib.symbolicate(address)
+
+    def symbolicate_many(self, addresses):
+        '''
+        Given a list of (module, address) pairs, return a list of
+        corresponding Symbols, or None for addresses that cannot be
+        symbolicated.
+        '''
+        symbols = [None] * len(addresses)
+        modules = {}
+        for i, (module, address) in enumerate(addresses):
+            modules.setdefault(module, []).append(i)
+        for module, indices in modules.iteritems():
+            lib = self._getLibrary(module)
+            if not lib:
+                continue
+            found = lib.symbolicate_many([addresses[i][1] for i in indices])
+            for i, symbol in zip(indices, found):
+                symbols[i] = symbol
+        return symbols
+
+    def close(self):
+        for lib in self._libs.itervalues():
+            if lib:
+                lib.close()
+
 class Symbolicator:
 
     class Product(object):
@@ -166,7 +763,7 @@ class Symbolicator:
             return self._SCRATCH.format(**self._params)
 
         def getServer(self):
-            return self._SERVER
+            return SYMBOL_SERVER or self._SERVER
 
         def getPath(self):
             return self._PATH.format(**self._params)
@@ -182,19 +779,37 @@ class Symbolicator:
         def moduleMatches(self, stackMod, localMod):
             return stackMod[-1] == localMod[-1]
 
-        def symbolicate(self, module, address):
+        def getSymbolFile(self, module):
             if module in self._mods:
-                return self._mods[module].symbolicate(address)
+                return self._mods[module]
 
+            # cache a negative entry unless a matching version is found
+            self._mods[module] = None
             versions = os.listdir(module)
             while versions:
-                sym = os.path.join(module, versions.pop())
+                version = versions.pop()
+                sym = os.path.join(module, version)
                 sym = os.path.join(sym, next(
                     f for f in os.listdir(sym) if f.endswith(self._SYM_EXT)))
-                symfile = BreakpadSymbolFile(sym)
+                # version directories are named after the breakpad ID, so
+                # builds that ship the same library share its symbol file
+                symfile = _symbolFiles.get(
+                    (os.path.basename(module), version),
+                    lambda: BreakpadSymbolFile(sym))
                 if symfile.architecture == self._params['symarch']:
                     self._mods[module] = symfile
-                    return symfile.symbolicate(address)
+                    return symfile
+
+        def symbolicate(self, module, address):
+            symfile = self.getSymbolFile(module)
+            if symfile:
+                return symfile.symbolicate(address)
+
+        def symbolicate_many(self, module, addresses):
+            symfile = self.getSymbolFile(module)
+            if not symfile:
+                return [None] * len(addresses)
+            return symfile.symbolicate_many(addresses)
 
     class Desktop(Product):
         _PATH = ('/pub/mozilla.org/firefox/nightly/{build_Y}/{build_m}/'
@@ -278,83 +893,371 @@ class Symbolicator:
                 return None
         return cls(scratch, product(info))
 
+    _MANIFEST = 'extracted.json'
+    # unstripped libraries placed here are symbolicated with addr2line
+    _UNSTRIPPED = 'unstripped'
+
     def __init__(self, scratch, product):
         self._product = product
         self._scratch = os.path.join(scratch, product.getScratch())
+        self._archive = None
+        self._requestedMods = set()
+        self._resetModules()
+
+    def _resetModules(self):
+        self._localMods = None
+        self._deviceMods = {}
+
+    def _findModule(self, module):
+        '''
+        Return the local module directory matching a device module path,
+        or None if there is no unique match. Results are cached, so the
+        scratch directory is only listed once.
+        '''
+        if module in self._deviceMods:
+            return self._deviceMods[module]
+
+        if self._localMods is None:
+            self._localMods = [(mod, mod.split(os.path.sep)) for mod in
+                               self._product.getModules(self._scratch)]
 
-    def symbolicate(self, module, address):
         device_mod = self._product.splitPath(module)
-        local_mods = list(self._product.getModules(self._scratch))
+        matching_mods = [mod for mod, local_mod in self._localMods if
+            self._product.moduleMatches(device_mod, local_mod)]
 
-        matching_mods = [mod for mod in local_mods if
-            self._product.moduleMatches(device_mod, mod.split(os.path.sep))]
+        local = matching_mods[0] if len(matching_mods) == 1 else None
+        self._deviceMods[module] = local
+        return local
+
+    def _requireModules(self, modules):
+        '''
+        When extracting selectively, extract the symbols for any of the
+        given device modules that have not been requested before.
+        '''
+        if not self._archive:
+            return
+        modules = set(modules) - self._requestedMods
+        if modules:
+            self._requestedMods.update(modules)
+            self.extractSymbols(self._archive, self._scratch, modules)
 
-        if len(matching_mods) != 1:
+    def symbolicate(self, module, address):
+        self._requireModules([module])
+        local = self._findModule(module)
+        if not local:
             raise Exception("Cannot find module")
+        return self._product.symbolicate(local, address)
+
+    def symbolicate_many(self, addresses):
+        '''
+        Given a list of (module, address) pairs, return a list of
+        corresponding Symbols, or None for addresses that cannot be
+        symbolicated. Addresses are grouped by module so each symbol
+        file is searched once.
+        '''
+        symbols = [None] * len(addresses)
+        modules = {}
+        for i, (module, address) in enumerate(addresses):
+            modules.setdefault(module, []).append(i)
+        self._requireModules(modules)
+        for module, indices in modules.iteritems():
+            localMod = self._findModule(module)
+            if not localMod:
+                continue
+            try:
+                found = self._product.symbolicate_many(
+                    localMod, [addresses[i][1] for i in indices])
+            except Exception:
+                continue
+            for i, symbol in zip(indices, found):
+                symbols[i] = symbol
+        return symbols
+
+    def _loadManifest(self, archive, scratch):
+        '''
+        Load the record of what has been extracted from the archive.
+        '''
+        stat = os.stat(archive)
+        key = [os.path.basename(archive), stat.st_size, stat.st_mtime]
+        try:
+            with open(os.path.join(scratch, self._MANIFEST), 'r') as f:
+                manifest = json.load(f)
+            if manifest['archive'] == key:
+                return manifest
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        return {'archive': key, 'complete': False, 'members': []}
 
-        return self._product.symbolicate(matching_mods[0], address)
+    def _saveManifest(self, manifest, scratch):
+        fd, tmp = tempfile.mkstemp(dir=scratch, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, os.path.join(scratch, self._MANIFEST))
 
-    def extractSymbols(self, archive, scratch):
+    def _checkMembers(self, names, scratch):
+        if not all(os.path.realpath(os.path.join(scratch, f)).startswith(
+                   os.path.realpath(scratch)) for f in names):
+            raise Exception("Invalid archive")
+
+    def _extractMember(self, arc, name, scratch):
+        '''
+        Stream a single archive member to disk.
+        '''
+        dst = os.path.join(scratch, name)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst))
+        with os.fdopen(fd, 'wb') as f:
+            src = arc.open(name)
+            try:
+                shutil.copyfileobj(src, f, 1 << 20)
+            finally:
+                src.close()
+        os.rename(tmp, dst)
+
+    def extractSymbols(self, archive, scratch, modules=None):
+        '''
+        Extract symbols from the archive into scratch. If modules is given,
+        only extract symbol files for those device modules. A manifest in
+        scratch records what has been extracted, so it is not rechecked.
+        '''
+        manifest = self._loadManifest(archive, scratch)
+        if manifest['complete']:
+            return
         with zipfile.ZipFile(archive, 'r') as arc:
             namelist = arc.namelist()
-            if all(os.path.exists(os.path.join(scratch, n)) for n in namelist):
-                return
-            if not all(os.path.realpath(os.path.join(scratch, f)).startswith(
-                       os.path.realpath(scratch)) for f in namelist):
-                raise Exception("Invalid archive")
-            arc.extractall(scratch)
-
-    def fetchSymbols(self):
+            if modules is None:
+                if not all(os.path.exists(os.path.join(scratch, n))
+                           for n in namelist):
+                    self._checkMembers(namelist, scratch)
+                    arc.extractall(scratch)
+                manifest['complete'] = True
+            else:
+                device_mods = [self._product.splitPath(m) for m in modules]
+                extracted = set(manifest['members'])
+                names = [n for n in namelist
+                         if n.endswith(self._product._SYM_EXT) and
+                            n not in extracted and
+                            any(self._product.moduleMatches(
+                                    device_mod, n.split('/')[:1])
+                                for device_mod in device_mods)]
+                self._checkMembers(names, scratch)
+                for name in names:
+                    self._extractMember(arc, name, scratch)
+                manifest['members'].extend(names)
+        self._saveManifest(manifest, scratch)
+        self._resetModules()
+
+    def downloadSymbols(self, downloader=None):
+        '''
+        Download the symbol archive unless it is already present,
+        and return its local path.
+        '''
         if not os.path.exists(self._scratch):
             os.makedirs(self._scratch)
         path = self._product.getPath()
         fname = self._product.getFile()
         dst = os.path.join(self._scratch, fname)
 
-        def download(ftp, src, dst):
-            with open(dst, 'wb') as f:
-                def write(s):
-                    f.write(s)
-                ftp.retrbinary('RETR ' + src, write)
-
         if not os.path.exists(dst):
-            ftp = ftplib.FTP(self._product.getServer())
+            owner = not downloader
+            if owner:
+                downloader = SymbolDownloader(self._product.getServer())
             try:
-                ftp.login()
-                download(ftp, path + '/' + fname, dst)
+                downloader.download(path + '/' + fname, dst)
             finally:
-                ftp.quit()
+                if owner:
+                    downloader.close()
 
         if not os.path.exists(dst):
             raise Exception("Cannot download symbols")
+        return dst
+
+    def fetchSymbols(self, selective=False):
+        dst = self.downloadSymbols()
 
+        if selective:
+            # symbols are extracted as modules are requested
+            self._archive = dst
+            return
         self.extractSymbols(dst, self._scratch)
 
-def symbolicateStack(stack, sym=None, scratch=None, info=None):
-    if not sym:
-        sym = Symbolicator.fromBuild(scratch, info)
+def _closeSymbolicator(sym):
+    '''
+    Stop any helper processes, such as addr2line, started by a symbolicator.
+    '''
+    if sym and hasattr(sym, 'close'):
+        sym.close()
+
+_symbolicators = LRUCache(SYMBOLICATOR_CACHE_SIZE, _closeSymbolicator)
+_symbolFiles = LRUCache(SYMBOL_FILE_CACHE_SIZE)
+
+def setSymbolServer(server):
+    '''
+    Download symbol archives from the given server URL.
+    '''
+    global SYMBOL_SERVER
+    SYMBOL_SERVER = server
+
+def _fromBuild(scratch, info):
+    '''
+    Return a Symbolicator for the build of the given info dict, or None if
+    its symbols cannot be located, for example for an unknown architecture
+    or a malformed build ID.
+    '''
+    try:
+        return Symbolicator.fromBuild(scratch, info)
+    except (KeyError, ValueError) as e:
+        print 'Skipping symbols for build %s: %s %s' % (
+            buildKey(info), type(e).__name__, e)
+        return None
+
+def prefetchSymbols(scratch, infos, threads=PREFETCH_THREADS):
+    '''
+    Download the symbol archives for the builds of the given info dicts
+    concurrently, so later symbolication does not wait on the network.
+    Return the number of builds whose archives are available.
+    '''
+    syms = {}
+    for info in infos:
+        sym = _fromBuild(scratch, info)
+        if sym:
+            syms[sym._scratch] = sym
+    if not syms:
+        return 0
+
+    downloaders = {}
+    for sym in syms.itervalues():
+        server = sym._product.getServer()
+        if server not in downloaders:
+            downloaders[server] = SymbolDownloader(server)
+
+    def fetch(sym):
         try:
-            sym.fetchSymbols()
-        except:
-            for f in stack:
-                yield f if isinstance(f, basestring) else str(f)
-            return
+            sym.downloadSymbols(downloaders[sym._product.getServer()])
+            return True
+        except Exception:
+            return False
 
-    for f in stack:
-        frame = f if isinstance(f, basestring) else str(f)
-        if not frame.startswith('c:'):
-            # only C stacks need symbolicating
-            yield frame
-            continue
-        ident, lib, addr = frame.split(':', 2)
-        if not addr or not addr[0].isdigit():
-            yield frame
-            continue
+    pool = ThreadPool(min(threads, len(syms)))
+    try:
+        return sum(pool.map(fetch, syms.values(), chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+        for downloader in downloaders.itervalues():
+            downloader.close()
+
+def buildKey(info):
+    '''
+    Return a key identifying the build, and so the symbols, for an info dict.
+    '''
+    return (info.get('appName'), info.get('appBuildID'),
+            info.get('appUpdateChannel'), info.get('platform'),
+            info.get('arch'))
+
+def getSymbolicator(scratch, info):
+    '''
+    Return a Symbolicator with symbols fetched for the given build,
+    or None if symbols are not available. Symbolicators are cached
+    by build, so each build is only set up once per process.
+    '''
+    key = (scratch,) + buildKey(info)
+
+    def create():
+        sym = _fromBuild(scratch, info)
+        if not sym:
+            return None
+        if isinstance(sym._product, Symbolicator.Mobile):
+            libdir = os.path.join(sym._scratch, Symbolicator._UNSTRIPPED)
+            if os.path.isdir(libdir):
+                return Addr2LineSymbolicator(libdir)
         try:
-            symbol = sym.symbolicate(lib, int(addr, 0))
-            func = symbol.function
-            if symbol.source or symbol.line:
-                func += ' (%s:%s)' % (symbol.source, str(symbol.line))
-            yield ':'.join((ident, symbol.library, func))
+            sym.fetchSymbols(selective=True)
         except:
-            yield frame
+            return None
+        return sym
+
+    return _symbolicators.get(key, create)
+
+def _stackAddresses(stacks):
+    '''
+    Return the native frames of the stacks, as (stack, index, ident)
+    tuples, and their corresponding (module, address) pairs.
+    '''
+    frames = []
+    addresses = []
+    for stack in stacks:
+        for index, frame in enumerate(stack):
+            if not frame.startswith('c:'):
+                # only C stacks need symbolicating
+                continue
+            ident, sep, rest = frame.partition(':')
+            lib, sep, addr = rest.partition(':')
+            if not addr or not addr[0].isdigit():
+                continue
+            try:
+                address = int(addr, 0)
+            except ValueError:
+                continue
+            frames.append((stack, index, ident))
+            addresses.append((lib, address))
+    return frames, addresses
+
+def needsSymbols(stacks, info):
+    '''
+    Return whether symbolicating the stacks of the build of the given info
+    dict needs the build's symbols, because the symbol cache does not have
+    every address in the stacks.
+    '''
+    frames, addresses = _stackAddresses(stacks)
+    if not addresses:
+        return False
+    if not _symbolCache:
+        return True
+    found = _symbolCache.lookup(buildKey(info), addresses)
+    return len(found) < len(set(addresses))
+
+def symbolicateStacks(stacks, sym=None, scratch=None, info=None):
+    stacks = [[f if isinstance(f, basestring) else str(f) for f in stack]
+              for stack in stacks]
+    frames, addresses = _stackAddresses(stacks)
+    if not addresses:
+        return stacks
+
+    # the cache is keyed by build, so it is consulted before any symbols
+    # are fetched for the build
+    cache = _symbolCache if info is not None else None
+    found = cache.lookup(buildKey(info), addresses) if cache else {}
+    missing = sorted(set(addresses) - set(found))
+    if missing:
+        if not sym:
+            sym = getSymbolicator(scratch, info)
+        symbols = None
+        if sym:
+            try:
+                symbols = sym.symbolicate_many(missing)
+            except:
+                pass
+            finally:
+                # addr2line processes are restarted on demand, so they
+                # are not left running between builds
+                _closeSymbolicator(sym)
+        if symbols is not None:
+            resolved = dict(zip(missing, symbols))
+            if cache:
+                cache.store(buildKey(info), resolved)
+            found.update(resolved)
+
+    for (stack, index, ident), address in zip(frames, addresses):
+        symbol = found.get(address)
+        if not symbol:
+            continue
+        func = symbol.function
+        if symbol.source or symbol.line:
+            func += ' (%s:%s)' % (symbol.source, str(symbol.line))
+        stack[index] = ':'.join((ident, symbol.library, func))
+    return stacks
+
+def symbolicateStack(stack, sym=None, scratch=None, info=None):
+    return symbolicateStacks([stack], sym, scratch, info)[0]
@@ -0,0 +1,335 @@
+#!/usr/bin/env python2
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Tests for downloading symbol archives, against local HTTP and FTP servers
+# standing in for the symbol server. Run with
+#     python -m unittest test_symbolicator
+
+import os
+import re
+import shutil
+import socket
+import SimpleHTTPServer
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import symbolicator
+
+class QuietHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    # Serves the current directory like SimpleHTTPServer, which ignores
+    # Range headers, and records the headers of every request.
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+class RangeHTTPRequestHandler(QuietHTTPRequestHandler):
+    # Also honours 'Range: bytes=<offset>-' headers.
+
+    def do_GET(self):
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return QuietHTTPRequestHandler.do_GET(self)
+        self.server.requests.append((self.path, dict(self.headers)))
+        offset = int(match.group(1))
+        size = os.path.getsize(path)
+        if offset >= size:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%d' % (offset, size - 1, size))
+        self.send_header('Content-Length', str(size - offset))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            shutil.copyfileobj(f, self.wfile)
+
+class FTPHandler(SocketServer.StreamRequestHandler):
+    # Just enough of an anonymous, passive-mode FTP server for ftplib
+    # to log in and retrieve files, with REST to resume transfers.
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        self.reply('220 Ready')
+        offset = 0
+        data = None
+        try:
+            for line in iter(self.rfile.readline, ''):
+                cmd, sep, arg = line.strip().partition(' ')
+                cmd = cmd.upper()
+                self.server.requests.append((cmd, arg))
+                if cmd == 'USER':
+                    self.reply('331 Send password')
+                elif cmd == 'PASS':
+                    self.reply('230 Logged in')
+                elif cmd == 'TYPE':
+                    self.reply('200 Type set')
+                elif cmd == 'PASV':
+                    if data:
+                        data.close()
+                    data = socket.socket()
+                    data.bind(('127.0.0.1', 0))
+                    data.listen(1)
+                    data.settimeout(10)
+                    port = data.getsockname()[1]
+                    self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' %
+                               (port >> 8, port & 0xff))
+                elif cmd == 'REST':
+                    offset = int(arg)
+                    self.reply('350 Restarting at %d' % offset)
+                elif cmd == 'RETR':
+                    path = os.path.join(self.server.root, arg.lstrip('/'))
+                    conn = data.accept()[0] if data else None
+                    if not conn or not os.path.isfile(path):
+                        self.reply('550 No such file')
+                    else:
+                        self.reply('150 Opening data connection')
+                        with open(path, 'rb') as f:
+                            f.seek(offset)
+                            shutil.copyfileobj(f, conn.makefile('wb'))
+                        self.reply('226 Transfer complete')
+                    if conn:
+                        conn.close()
+                    data.close()
+                    data = None
+                    offset = 0
+                elif cmd == 'QUIT':
+                    self.reply('221 Bye')
+                    break
+                else:
+                    self.reply('502 Not implemented')
+        finally:
+            if data:
+                data.close()
+
+class ServerThread(threading.Thread):
+
+    def __init__(self, server):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.server.requests = []
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class ThreadingServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class SymbolServerTest(unittest.TestCase):
+
+    ARCHIVE = 'symbols.zip'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.scratch = tempfile.mkdtemp()
+        self.data = ''.join(chr(i % 251) for i in range(1 << 18))
+        self.writeFile(self.ARCHIVE, self.data)
+        self.servers = []
+        self.cwd = os.getcwd()
+        # SimpleHTTPServer serves the current directory
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        for server in self.servers:
+            server.stop()
+        symbolicator.setSymbolServer('')
+        shutil.rmtree(self.root, True)
+        shutil.rmtree(self.scratch, True)
+
+    def writeFile(self, path, data):
+        path = os.path.join(self.root, path.lstrip('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def startServer(self, server):
+        thread = ServerThread(server)
+        thread.start()
+        self.servers.append(thread)
+        return server
+
+    def startHTTP(self, handler=RangeHTTPRequestHandler):
+        server = self.startServer(ThreadingServer(('127.0.0.1', 0), handler))
+        return 'http://127.0.0.1:%d' % server.server_address[1], server
+
+    def startFTP(self):
+        server = self.startServer(ThreadingServer(('127.0.0.1', 0), FTPHandler))
+        server.root = self.root
+        return 'ftp://127.0.0.1:%d' % server.server_address[1], server
+
+    def download(self, url, path='/' + ARCHIVE, partial=None):
+        dst = os.path.join(self.scratch, self.ARCHIVE)
+        if partial is not None:
+            with open(dst + '.part', 'wb') as f:
+                f.write(partial)
+        downloader = symbolicator.SymbolDownloader(url)
+        try:
+            downloader.download(path, dst)
+        finally:
+            downloader.close()
+        self.assertFalse(os.path.exists(dst + '.part'))
+        with open(dst, 'rb') as f:
+            return f.read()
+
+    def rangeHeaders(self, server):
+        return [headers.get('range') for path, headers in server.requests]
+
+    def testHTTPDownload(self):
+        url, server = self.startHTTP()
+        self.assertEqual(self.download(url), self.data)
+        self.assertEqual(self.rangeHeaders(server), [None])
+
+    def testHTTPResume(self):
+        url, server = self.startHTTP()
+        self.assertEqual(self.download(url, partial=self.data[:1000]),
+                         self.data)
+        self.assertEqual(self.rangeHeaders(server), ['bytes=1000-'])
+
+    def testHTTPResumeComplete(self):
+        url, server = self.startHTTP()
+        self.assertEqual(self.download(url, partial=self.data), self.data)
+
+    def testHTTPIgnoredRange(self):
+        url, server = self.startHTTP(QuietHTTPRequestHandler)
+        # a stale partial file is replaced by the whole file
+        self.assertEqual(self.download(url, partial='stale'), self.data)
+        self.assertEqual(self.rangeHeaders(server), ['bytes=5-'])
+
+    def testHTTPNotFound(self):
+        url, server = self.startHTTP()
+        dst = os.path.join(self.scratch, self.ARCHIVE)
+        self.assertRaises(IOError, self.download, url, path='/missing.zip')
+        self.assertFalse(os.path.exists(dst))
+
+    def testHTTPBasePath(self):
+        self.writeFile('/mirror/' + self.ARCHIVE, self.data[::-1])
+        url, server = self.startHTTP()
+        self.assertEqual(self.download(url + '/mirror/'), self.data[::-1])
+
+    def testFTPDownload(self):
+        url, server = self.startFTP()
+        self.assertEqual(self.download(url), self.data)
+        self.assertNotIn('REST', [cmd for cmd, arg in server.requests])
+
+    def testFTPResume(self):
+        url, server = self.startFTP()
+        self.assertEqual(self.download(url, partial=self.data[:1000]),
+                         self.data)
+        self.assertIn(('REST', '1000'), server.requests)
+
+    def testFTPNotFound(self):
+        url, server = self.startFTP()
+        dst = os.path.join(self.scratch, self.ARCHIVE)
+        self.assertRaises(Exception, self.download, url, path='/missing.zip')
+        self.assertFalse(os.path.exists(dst))
+
+    def testPrefetchSymbols(self):
+        infos = [{
+            'appName': 'Firefox',
+            'appBuildID': '20150401030201',
+            'appUpdateChannel': 'nightly',
+            'appVersion': '40.0a1',
+            'platform': 'Linux',
+            'arch': 'x86-64',
+        }, {
+            'appName': 'Firefox',
+            'appBuildID': '20150402030201',
+            'appUpdateChannel': 'aurora',
+            'appVersion': '39.0a2',
+            'platform': 'WINNT',
+            'arch': 'x86',
+        }, {
+            'appName': 'Fennec',
+            'appBuildID': '20150401030201',
+            'appUpdateChannel': 'nightly',
+            'appVersion': '40.0a1',
+            'platform': 'Android',
+            'arch': 'armv7',
+        }, {
+            # unknown architecture
+            'appName': 'Fennec',
+            'appBuildID': '20150401030201',
+            'appUpdateChannel': 'nightly',
+            'appVersion': '40.0a1',
+            'platform': 'Android',
+            'arch': 'mips',
+        }, {
+            # malformed build ID
+            'appName': 'Firefox',
+            'appBuildID': '2015040103',
+            'appUpdateChannel': 'nightly',
+            'appVersion': '40.0a1',
+            'platform': 'Linux',
+            'arch': 'x86',
+        }, {
+            # no archive on the server
+            'appName': 'Fennec',
+            'appBuildID': '20150403030201',
+            'appUpdateChannel': 'nightly',
+            'appVersion': '40.0a1',
+            'platform': 'Android',
+            'arch': 'x86',
+        }]
+        url, server = self.startHTTP()
+        symbolicator.setSymbolServer(url)
+
+        archives = {}
+        for i, info in enumerate(infos[:3] + infos[5:]):
+            product = symbolicator.Symbolicator.fromBuild(
+                self.scratch, info)._product
+            dst = os.path.join(self.scratch, product.getScratch(),
+                               product.getFile())
+            archives[dst] = 'archive %d' % i
+            if i < 3:
+                self.writeFile(product.getPath() + '/' + product.getFile(),
+                               archives[dst])
+
+        # duplicate builds are only fetched once
+        self.assertEqual(symbolicator.prefetchSymbols(
+            self.scratch, infos + infos[:1], threads=2), 3)
+        self.assertEqual(len(server.requests), 4)
+        for i, (dst, data) in enumerate(sorted(archives.iteritems(),
+                                               key=lambda x: x[1])):
+            if i < 3:
+                with open(dst, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            else:
+                self.assertFalse(os.path.exists(dst))
+
+        # builds whose symbols cannot be located are skipped
+        self.assertEqual(symbolicator.getSymbolicator(self.scratch, infos[3]),
+                         None)
+        self.assertEqual(symbolicator.getSymbolicator(self.scratch, infos[4]),
+                         None)
+
+        # archives already on disk are not downloaded again
+        self.assertEqual(symbolicator.prefetchSymbols(
+            self.scratch, infos[:3]), 3)
+        self.assertEqual(len(server.requests), 4)
+
+if __name__ == '__main__':
+    unittest.main()